@@ -0,0 +1,90 @@
+"""Сравнение KeywordMatcher с исходным циклом по подстрокам.
+
+Запуск:
+    python bench_matcher.py --users 5000 --keywords 5 --length 2000
+"""
+import argparse
+import random
+import time
+from typing import Dict, List, Set
+
+from matcher import KeywordMatcher
+
+WORDS = [
+    "python", "developer", "data", "analyst", "senior", "junior", "lead",
+    "backend", "frontend", "remote", "office", "engineer", "manager",
+    "разработчик", "аналитик", "удаленно", "вакансия", "стажер", "тимлид",
+    "django", "fastapi", "golang", "kotlin", "devops", "ml", "qa",
+]
+
+def generate_keywords(users: int, per_user: int, rng: random.Random) -> Dict[int, Set[str]]:
+    """Пересекающиеся наборы фраз из одного-двух слов"""
+    result = {}
+    for user_id in range(users):
+        keywords = set()
+        for _ in range(per_user):
+            size = rng.choice((1, 2, 2))
+            keywords.add(" ".join(rng.choice(WORDS) for _ in range(size)))
+        result[user_id] = keywords
+    return result
+
+def generate_messages(count: int, length: int, rng: random.Random) -> List[str]:
+    messages = []
+    for _ in range(count):
+        words = []
+        total = 0
+        while total < length:
+            word = rng.choice(WORDS + ["и", "в", "на", "for", "the", "Компания", "ищет"])
+            if rng.random() < 0.2:
+                word = word.capitalize()
+            words.append(word)
+            total += len(word) + 1
+        messages.append(" ".join(words)[:length])
+    return messages
+
+def naive_match(keywords_by_user: Dict[int, Set[str]], text: str) -> Set[int]:
+    """Исходная логика из bot.py"""
+    return {
+        user_id
+        for user_id, keywords in keywords_by_user.items()
+        if any(kw.lower() in text.lower() for kw in keywords)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--keywords', type=int, default=5, help="ключевых слов на пользователя")
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--length', type=int, default=2000, help="длина сообщения в символах")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    keywords_by_user = generate_keywords(args.users, args.keywords, rng)
+    messages = generate_messages(args.messages, args.length, rng)
+
+    started = time.perf_counter()
+    matcher = KeywordMatcher(keywords_by_user)
+    build_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    naive_results = [naive_match(keywords_by_user, text) for text in messages]
+    naive_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    matcher_results = [matcher.match(text) for text in messages]
+    matcher_time = time.perf_counter() - started
+
+    if naive_results != matcher_results:
+        raise SystemExit("Результаты KeywordMatcher расходятся с циклом по подстрокам")
+
+    per_message = 1000 / args.messages
+    print(f"Пользователей: {args.users}, уникальных шаблонов: {matcher.pattern_count}")
+    print(f"Сообщений: {args.messages} по {args.length} символов")
+    print(f"Построение автомата: {build_time * 1000:.1f} мс")
+    print(f"Цикл по подстрокам: {naive_time * per_message:.2f} мс/сообщение")
+    print(f"KeywordMatcher:     {matcher_time * per_message:.2f} мс/сообщение")
+    print(f"Ускорение: x{naive_time / matcher_time:.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+"""Нагрузочный тест пути прием -> поиск -> доставка из bot.py.
+
+Сообщения каналов имитируются объектами, похожими на сообщения Telethon,
+и подаются в dispatch_channel_message с заданной частотой. Вместо Bot API
+используется локальная заглушка с настраиваемой задержкой ответа.
+Журнал доставок, настройки и отметки каналов пишутся во временный каталог.
+
+Запуск:
+    python bench_pipeline.py --users 100000 --channels 1000 --rate 50 --media 0.2 --output run.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # На Windows модуля resource нет
+    resource = None
+
+# Peer ID каналов в Telethon имеют вид -100XXXXXXXXXX
+CHANNEL_ID_BASE = -1000000000000
+
+def rss_mb() -> Optional[float]:
+    """Текущий размер резидентной памяти процесса"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_mb() -> Optional[float]:
+    """Пиковый размер резидентной памяти процесса"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+def channel_weights(channels: int) -> List[float]:
+    """Накопленные веса каналов: популярность убывает по закону Ципфа"""
+    weights = []
+    total = 0.0
+    for rank in range(channels):
+        total += 1 / (rank + 1)
+        weights.append(total)
+    return weights
+
+def vocabulary(size: int) -> List[str]:
+    """Синтетический словарь: доля совпадений задается его размером"""
+    return [f"слово{i:06d}" for i in range(size)]
+
+def generate_text(words: List[str], length: int, rng: random.Random) -> str:
+    parts = []
+    total = 0
+    while total < length:
+        word = rng.choice(words)
+        parts.append(word)
+        total += len(word) + 1
+    return " ".join(parts)[:length]
+
+def write_settings(path: str, args, rng: random.Random) -> None:
+    """Файл настроек в формате UserSettingsStorage"""
+    channel_ids = [CHANNEL_ID_BASE - i for i in range(args.channels)]
+    weights = channel_weights(args.channels)
+    words = vocabulary(args.vocabulary)
+    users = {}
+    for user_id in range(args.users):
+        # Фразы из одного-двух слов, как у настоящих пользователей
+        keywords = {
+            " ".join(rng.choice(words) for _ in range(rng.choice((1, 1, 2))))
+            for _ in range(args.keywords)
+        }
+        channels = set(rng.choices(channel_ids, cum_weights=weights, k=args.subscriptions))
+        users[str(user_id + 1)] = {
+            'channels': sorted(channels),
+            'keywords': sorted(keywords),
+            'active': True,
+        }
+    data = {
+        'users': users,
+        'channels': {
+            str(channel_id): {'username': f"bench_channel_{i}", 'title': f"Канал {i}"}
+            for i, channel_id in enumerate(channel_ids)
+        },
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+class FakeFile:
+    def __init__(self, size: int):
+        self.size = size
+        self.ext = '.jpg'
+
+class FakeMessage:
+    """Минимальная замена telethon.tl.custom.Message"""
+
+    def __init__(
+        self,
+        stats: Counter,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        media_size: int = 0,
+        grouped_id: Optional[int] = None,
+        download_latency: float = 0,
+    ):
+        self.stats = stats
+        self.chat_id = chat_id
+        self.id = message_id
+        self.text = text
+        self.message = text
+        self.grouped_id = grouped_id
+        self.media = SimpleNamespace() if media_size else None
+        self.file = FakeFile(media_size) if media_size else None
+        self.chat = None
+        self.download_latency = download_latency
+        # Момент публикации для расчета задержки до доставки
+        self.published_at = 0.0
+
+    async def download_media(self, file=None):
+        self.stats['download_media'] += 1
+        await asyncio.sleep(self.download_latency)
+        data = bytes(self.file.size)
+        if file is bytes:
+            return data
+        with open(file, 'wb') as f:
+            f.write(data)
+        return file
+
+class FakeBot:
+    """Заглушка telegram.Bot: считает вызовы и отвечает с задержкой"""
+
+    def __init__(self, stats: Counter, latency: float):
+        self.stats = stats
+        self.latency = latency
+        self._file_ids = 0
+
+    def _photo(self):
+        self._file_ids += 1
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"bench_file_{self._file_ids}")])
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.stats['send_message'] += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(photo=None)
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self.stats['send_photo'] += 1
+        await asyncio.sleep(self.latency)
+        return self._photo()
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.stats['send_media_group'] += 1
+        await asyncio.sleep(self.latency)
+        return [self._photo() for _ in media]
+
+def generate_workload(args, stats: Counter, rng: random.Random) -> List[List[FakeMessage]]:
+    """Поток сообщений: каждый элемент - одиночное сообщение или альбом"""
+    channel_ids = [CHANNEL_ID_BASE - i for i in range(args.channels)]
+    weights = channel_weights(args.channels)
+    words = vocabulary(args.vocabulary)
+    texts = [generate_text(words, args.length, rng) for _ in range(args.messages)]
+    last_ids: Dict[int, int] = {}
+    grouped_ids = 0
+    workload = []
+    for text in texts:
+        chat_id = rng.choices(channel_ids, cum_weights=weights)[0]
+        size = 1
+        media_size = 0
+        grouped_id = None
+        if rng.random() < args.media:
+            media_size = args.media_size
+            if rng.random() < args.albums:
+                size = rng.randint(2, 4)
+                grouped_ids += 1
+                grouped_id = grouped_ids
+        group = []
+        for i in range(size):
+            last_ids[chat_id] = last_ids.get(chat_id, 0) + 1
+            group.append(FakeMessage(
+                stats,
+                chat_id,
+                last_ids[chat_id],
+                text if i == 0 else "",
+                media_size=media_size,
+                grouped_id=grouped_id,
+                download_latency=args.download_latency,
+            ))
+        workload.append(group)
+    return workload
+
+async def run(args, bot, workload: List[List[FakeMessage]], stats: Counter) -> Dict:
+    from delivery import DeliveryScheduler
+
+    latencies: List[float] = []
+    dispatch_times: List[float] = []
+    failures = Counter()
+
+    async def on_done(job):
+        latencies.append(time.perf_counter() - job.message.published_at)
+        await bot.on_delivery_done(job)
+
+    async def on_failed(job, error):
+        failures[type(error).__name__] += 1
+        await bot.on_delivery_failed(job, error)
+
+    # Тот же планировщик, что в bot.py, но с учетом задержки каждой доставки
+    bot.application = SimpleNamespace(bot=FakeBot(stats, args.api_latency))
+    bot.delivery_scheduler = DeliveryScheduler(
+        send=bot.deliver_job,
+        on_done=on_done,
+        on_failed=on_failed,
+        workers=args.workers,
+        queue_size=bot.DELIVERY_QUEUE_SIZE,
+        global_rate=args.global_rate,
+        chat_rate=args.chat_rate,
+    )
+    bot.delivery_scheduler.start()
+    bot.outbox.start()
+    bot.high_water_marks.start()
+
+    async def dispatch(group: List[FakeMessage]):
+        started = time.perf_counter()
+        album = group if group[0].grouped_id else None
+        await bot.dispatch_channel_message(group[0].chat_id, group[0], album=album)
+        dispatch_times.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, group in enumerate(workload):
+        if args.rate > 0:
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        published_at = time.perf_counter()
+        for message in group:
+            message.published_at = published_at
+        # Telethon обрабатывает каждое обновление в отдельной задаче
+        tasks.append(asyncio.create_task(dispatch(group)))
+    await asyncio.gather(*tasks)
+    ingest_time = time.perf_counter() - started
+
+    drained = True
+    try:
+        await asyncio.wait_for(bot.delivery_scheduler.stop(drain=True), timeout=args.drain_timeout)
+    except asyncio.TimeoutError:
+        drained = False
+        await bot.delivery_scheduler.stop(drain=False)
+    total_time = time.perf_counter() - started
+
+    await bot.outbox.close()
+    await bot.high_water_marks.close()
+    await bot.storage.close()
+
+    messages = len(workload)
+    media_messages = sum(1 for group in workload if group[0].media)
+    deliveries = len(latencies)
+    api_calls = {name: stats[name] for name in ('send_message', 'send_photo', 'send_media_group')}
+    return {
+        'ingest': {
+            'messages': messages,
+            'media_messages': media_messages,
+            'albums': sum(1 for group in workload if group[0].grouped_id),
+            'duration_s': ingest_time,
+            'messages_per_s': messages / ingest_time if ingest_time else None,
+            'dispatch_p50_ms': ms(percentile(dispatch_times, 0.5)),
+            'dispatch_p99_ms': ms(percentile(dispatch_times, 0.99)),
+        },
+        'delivery': {
+            'deliveries': deliveries,
+            'failed': dict(failures),
+            'drained': drained,
+            'duration_s': total_time,
+            'deliveries_per_s': deliveries / total_time if total_time else None,
+            'deliveries_per_message': deliveries / messages if messages else None,
+            'latency_p50_ms': ms(percentile(latencies, 0.5)),
+            'latency_p99_ms': ms(percentile(latencies, 0.99)),
+            'latency_max_ms': ms(max(latencies) if latencies else None),
+        },
+        'api': {
+            'calls': api_calls,
+            'calls_per_message': sum(api_calls.values()) / messages if messages else None,
+            'downloads': stats['download_media'],
+            'downloads_per_media_message': (
+                stats['download_media'] / media_messages if media_messages else None
+            ),
+        },
+    }
+
+def ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--channels', type=int, default=1000)
+    parser.add_argument('--subscriptions', type=int, default=5, help="каналов на пользователя")
+    parser.add_argument('--keywords', type=int, default=5, help="ключевых слов на пользователя")
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=50, help="сообщений в секунду, 0 - без ограничения")
+    parser.add_argument('--length', type=int, default=500, help="длина сообщения в символах")
+    parser.add_argument('--vocabulary', type=int, default=20000, help="размер словаря текстов и ключевых слов")
+    parser.add_argument('--media', type=float, default=0.2, help="доля сообщений с фото")
+    parser.add_argument('--albums', type=float, default=0.3, help="доля альбомов среди сообщений с фото")
+    parser.add_argument('--media-size', type=int, default=200 * 1024, help="размер фото в байтах")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка ответа Bot API, сек")
+    parser.add_argument('--download-latency', type=float, default=0.1, help="задержка скачивания медиа, сек")
+    parser.add_argument('--workers', type=int, default=None, help="по умолчанию DELIVERY_WORKERS")
+    parser.add_argument('--global-rate', type=float, default=None, help="по умолчанию DELIVERY_GLOBAL_RATE")
+    parser.add_argument('--chat-rate', type=float, default=None, help="по умолчанию DELIVERY_CHAT_RATE")
+    parser.add_argument('--drain-timeout', type=float, default=300, help="ожидание доставки после приема, сек")
+    parser.add_argument('--backend', choices=('sqlite', 'json'), default='sqlite')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="файл для результатов в JSON, по умолчанию stdout")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        rss_start = rss_mb()
+        started = time.perf_counter()
+        json_file = os.path.join(workdir, 'user_settings.json')
+        write_settings(json_file, args, rng)
+        generate_time = time.perf_counter() - started
+
+        # bot.py читает конфигурацию при импорте
+        os.environ['SETTINGS_BACKEND'] = args.backend
+        os.environ['OUTBOX_FILE'] = os.path.join(workdir, 'outbox.db')
+        os.environ.pop('DEDUP_FILE', None)
+        if args.backend == 'sqlite':
+            from storage import migrate_json_to_sqlite
+            os.environ['SETTINGS_FILE'] = os.path.join(workdir, 'user_settings.db')
+            migrate_json_to_sqlite(json_file, os.environ['SETTINGS_FILE'])
+        else:
+            os.environ['SETTINGS_FILE'] = json_file
+
+        started = time.perf_counter()
+        import bot
+        load_time = time.perf_counter() - started
+        logging.getLogger().setLevel(args.log_level)
+        rss_loaded = rss_mb()
+
+        if args.workers is None:
+            args.workers = bot.DELIVERY_WORKERS
+        if args.global_rate is None:
+            args.global_rate = bot.DELIVERY_GLOBAL_RATE
+        if args.chat_rate is None:
+            args.chat_rate = bot.DELIVERY_CHAT_RATE
+
+        stats = Counter()
+        workload = generate_workload(args, stats, rng)
+        result = asyncio.run(run(args, bot, workload, stats))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'params': vars(args),
+        'startup': {
+            'users': args.users,
+            'channels': args.channels,
+            'generate_s': generate_time,
+            'load_s': load_time,
+        },
+        **result,
+        'memory': {
+            'rss_start_mb': rss_start,
+            'rss_after_load_mb': rss_loaded,
+            'rss_peak_mb': peak_rss_mb(),
+        },
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"Результаты записаны в {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
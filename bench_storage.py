@@ -0,0 +1,102 @@
+"""Память и время загрузки настроек пользователей.
+
+Генерирует файл настроек того же вида, что и bench_pipeline.py, и загружает
+его JSON- и SQLite-хранилищем. Каждая загрузка идет в отдельном процессе,
+чтобы общие таблицы каналов и ключевых слов строились заново. Время
+загрузки меряется без tracemalloc, память - отдельной загрузкой под
+tracemalloc: сколько занимают настройки вместе с индексом канал ->
+подписчики и сколько было занято на пике.
+
+Запуск:
+    python bench_storage.py --users 100000 --channels 1000 --output storage.json
+"""
+import argparse
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from bench_pipeline import write_settings
+from storage import CHANNELS, KEYWORDS, SqliteSettingsStorage, UserSettingsStorage, migrate_json_to_sqlite
+
+BACKENDS = {'json': UserSettingsStorage, 'sqlite': SqliteSettingsStorage}
+
+def load(backend: str, path: str, traced: bool) -> dict:
+    """Одна загрузка хранилища в текущем (свежем) процессе"""
+    gc.collect()
+    if traced:
+        tracemalloc.start()
+    started = time.perf_counter()
+    storage = BACKENDS[backend](path)
+    result = {'load_s': time.perf_counter() - started}
+    if traced:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result.update(retained_mb=current / 2 ** 20, peak_mb=peak / 2 ** 20)
+    result.update(
+        users=len(storage.get_all_settings()),
+        watched_channels=len(storage.get_watched_channels()),
+        interned_channels=len(CHANNELS),
+        interned_keywords=len(KEYWORDS),
+    )
+    return result
+
+def measure(backend: str, path: str) -> dict:
+    context = multiprocessing.get_context('spawn')
+    result = {}
+    for traced in (False, True):
+        with context.Pool(1) as pool:
+            sample = pool.apply(load, (backend, path, traced))
+        if traced:
+            sample.pop('load_s')
+        result.update(sample)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Память и время загрузки настроек пользователей")
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--channels', type=int, default=1000)
+    parser.add_argument('--subscriptions', type=int, default=5, help="каналов на пользователя")
+    parser.add_argument('--keywords', type=int, default=5, help="ключевых слов на пользователя")
+    parser.add_argument('--vocabulary', type=int, default=20000, help="размер словаря ключевых слов")
+    parser.add_argument('--backend', choices=('sqlite', 'json', 'both'), default='both')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="файл для результатов в JSON, по умолчанию stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='bench_storage_')
+    try:
+        json_file = os.path.join(workdir, 'user_settings.json')
+        started = time.perf_counter()
+        write_settings(json_file, args, random.Random(args.seed))
+        report = {
+            'params': vars(args),
+            'generate_s': time.perf_counter() - started,
+            'file_mb': os.path.getsize(json_file) / 2 ** 20,
+        }
+        if args.backend in ('json', 'both'):
+            report['json'] = measure('json', json_file)
+        if args.backend in ('sqlite', 'both'):
+            db_file = os.path.join(workdir, 'user_settings.db')
+            migrate_json_to_sqlite(json_file, db_file)
+            report['sqlite'] = measure('sqlite', db_file)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"Результаты записаны в {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,28 @@
 import os
 from telethon import TelegramClient, events
+from telethon.utils import resolve_id
 from telegram import Update, InputMediaPhoto
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 import logging
 import asyncio
 import re
+import itertools
+import signal
+import sys
+import time
 from typing import Optional, Set, List, Dict
-from storage import UserSettingsStorage
+from storage import create_storage
+from delivery import DeliveryJob, DeliveryScheduler
+from outbox import Outbox
+from catchup import ChannelCatchUp, HighWaterMarks
+from dedup import DeliveryDedup
+from digest import DigestBuffer, render_digest
+from watch import ChannelWatchSet
+from channels import ChannelResolveError, ChannelResolver, migrate_legacy_channels
+from media import MediaFanoutCache, download_media_buffer, media_cache_key, photo_file_id, spool_media
+from query import QuerySyntaxError, format_query, is_query, parse_query
+from metrics import DELIVERIES, MESSAGES, REGISTRY, STAGE_SECONDS, Gauge, start_metrics_server
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -19,12 +35,78 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 API_ID = int(os.environ.get('API_ID', 0))
 API_HASH = os.environ.get('API_HASH')
+MEDIA_CACHE_SIZE = int(os.environ.get('MEDIA_CACHE_SIZE', 1000))
+MEDIA_CACHE_TTL = int(os.environ.get('MEDIA_CACHE_TTL', 3600))
+# Параметры очереди доставки и лимиты Bot API (сообщений в секунду)
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', 8))
+DELIVERY_QUEUE_SIZE = int(os.environ.get('DELIVERY_QUEUE_SIZE', 1000))
+DELIVERY_GLOBAL_RATE = float(os.environ.get('DELIVERY_GLOBAL_RATE', 30))
+DELIVERY_CHAT_RATE = float(os.environ.get('DELIVERY_CHAT_RATE', 1))
+# Отдельные процессы доставки (worker.py), 0 - прием и доставка в одном процессе;
+# медиа для них скачивается в SPOOL_DIR
+DELIVERY_PROCESSES = int(os.environ.get('DELIVERY_PROCESSES', 0))
+SPOOL_DIR = os.environ.get('SPOOL_DIR', 'media_spool')
+# Журнал доставок и интервал проверки отложенных повторов (в секундах)
+OUTBOX_FILE = os.environ.get('OUTBOX_FILE', 'outbox.db')
+OUTBOX_RETRY_INTERVAL = float(os.environ.get('OUTBOX_RETRY_INTERVAL', 5))
+# Догрузка пропущенных сообщений: параллельных каналов и максимум сообщений на канал
+CATCHUP_CONCURRENCY = int(os.environ.get('CATCHUP_CONCURRENCY', 4))
+CATCHUP_LIMIT = int(os.environ.get('CATCHUP_LIMIT', 100))
+# Кэш повторно обработанных сообщений; DEDUP_FILE сохраняет его между запусками
+DEDUP_MAX_MESSAGES = int(os.environ.get('DEDUP_MAX_MESSAGES', 10000))
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', 86400))
+DEDUP_FILE = os.environ.get('DEDUP_FILE', '')
+# Режим дайджеста: период рассылки в минутах, записей на пользователя, символов текста в записи
+DIGEST_INTERVAL = float(os.environ.get('DIGEST_INTERVAL', 60))
+DIGEST_MAX_ITEMS = int(os.environ.get('DIGEST_MAX_ITEMS', 50))
+DIGEST_TEXT_LIMIT = int(os.environ.get('DIGEST_TEXT_LIMIT', 300))
+# Подписываться на новые отслеживаемые каналы и покидать неотслеживаемые
+WATCH_JOIN_CHANNELS = os.environ.get('WATCH_JOIN_CHANNELS', '0') == '1'
+WATCH_LEAVE_CHANNELS = os.environ.get('WATCH_LEAVE_CHANNELS', '0') == '1'
+# Файлы крупнее порога (в байтах) скачиваются во временный файл, а не в память
+MEDIA_MEMORY_LIMIT = int(os.environ.get('MEDIA_MEMORY_LIMIT', 10 * 1024 * 1024))
+# Размер кэша разрешения @username -> ID канала
+CHANNEL_CACHE_SIZE = int(os.environ.get('CHANNEL_CACHE_SIZE', 1000))
+# Локальный HTTP-сервер метрик Prometheus, 0 - выключен
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+# 0 - каждая доставка в INFO, N - каждая N-я доставка в DEBUG
+DELIVERY_LOG_SAMPLE = int(os.environ.get('DELIVERY_LOG_SAMPLE', 0))
 
 application: Optional[Application] = None
 client: Optional[TelegramClient] = None
+watch_set: Optional[ChannelWatchSet] = None
+channel_resolver: Optional[ChannelResolver] = None
+channel_catchup: Optional[ChannelCatchUp] = None
 
 # Структуры данных для хранения настроек пользователей
-storage = UserSettingsStorage()
+storage = create_storage()
+
+# Журнал доставок: задания переживают ошибки отправки и перезапуски
+outbox = Outbox(OUTBOX_FILE)
+# Последние обработанные сообщения каналов хранятся рядом с журналом
+high_water_marks = HighWaterMarks(OUTBOX_FILE)
+
+# Совпадения пользователей в режиме дайджеста ждут рассылки рядом с журналом
+digest_buffer = DigestBuffer(OUTBOX_FILE, max_items=DIGEST_MAX_ITEMS)
+
+# Повторы одного сообщения отсекаются до журнала, скачивания и отправки
+delivery_dedup = DeliveryDedup(max_messages=DEDUP_MAX_MESSAGES, ttl=DEDUP_TTL)
+
+# Кэш file_id медиа для рассылки одного сообщения многим подписчикам
+media_cache = MediaFanoutCache(max_entries=MEDIA_CACHE_SIZE, ttl=MEDIA_CACHE_TTL)
+
+# Подсказка по формату ключевых слов и запросов
+KEYWORDS_HELP = (
+    "Отправьте ключевые слова в кавычках через пробел.\n"
+    'Например: "data analyst" "python developer"\n\n'
+    "Можно составить запрос с AND, OR, NOT и скобками, тогда фразы ищутся как целые слова:\n"
+    '"python" AND ("senior" OR "lead") NOT "intern"\n'
+    'Звездочка в конце ищет по началу слова: "разработчик*"'
+)
+
+# Номер успешной доставки для выборочного логирования
+delivery_counter = itertools.count(1)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
@@ -49,13 +131,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка в обработчике start: {e}")
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
+def format_channel(channel) -> str:
+    """Отображаемое имя канала по его ID"""
+    info = storage.get_channel_info(channel)
+    if info is None:
+        return str(channel)
+    if info['username']:
+        return f"@{info['username']}"
+    return info['title']
+
 async def channels_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать список отслеживаемых каналов"""
     user_id = update.effective_chat.id
     if user_id not in storage.get_all_settings() or not storage.get_all_settings()[user_id]['channels']:
         await update.message.reply_text("Список каналов пуст")
     else:
-        channels = '\n'.join(storage.get_all_settings()[user_id]['channels'])
+        channels = '\n'.join(format_channel(channel) for channel in storage.get_all_settings()[user_id]['channels'])
         await update.message.reply_text(f"Отслеживаемые каналы:\n{channels}")
 
 async def channels_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -66,23 +157,41 @@ async def channels_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     context.user_data['awaiting_input'] = 'channels'
 
+def format_keyword(keyword: str) -> str:
+    """Фраза показывается в кавычках, запрос - как есть"""
+    return keyword if '"' in keyword else f'"{keyword}"'
+
 async def keywords_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать список ключевых слов"""
     user_id = update.effective_chat.id
     if user_id not in storage.get_all_settings() or not storage.get_all_settings()[user_id]['keywords']:
         await update.message.reply_text("Список ключевых слов пуст")
     else:
-        keywords = '\n'.join(f'"{kw}"' for kw in storage.get_all_settings()[user_id]['keywords'])
+        keywords = '\n'.join(format_keyword(kw) for kw in storage.get_all_settings()[user_id]['keywords'])
         await update.message.reply_text(f"Ключевые слова для поиска:\n{keywords}")
 
 async def keywords_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Изменить список ключевых слов"""
-    await update.message.reply_text(
-        "Отправьте ключевые слова в кавычках через пробел.\n"
-        'Например: "data analyst" "python developer"'
-    )
+    await update.message.reply_text(KEYWORDS_HELP)
     context.user_data['awaiting_input'] = 'keywords'
 
+async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Включить или выключить режим дайджеста"""
+    user_id = update.effective_chat.id
+    settings = storage.get_user_settings(user_id)
+    settings['digest'] = not settings.get('digest', False)
+    storage.update_user_settings(user_id, settings)
+    if settings['digest']:
+        await update.message.reply_text(
+            "Режим дайджеста включен.\n"
+            f"Найденные сообщения будут приходить одной сводкой раз в {DIGEST_INTERVAL:g} мин.\n"
+            "Повторите /digest, чтобы получать их сразу."
+        )
+    else:
+        await update.message.reply_text("Режим дайджеста выключен, сообщения снова приходят сразу.")
+        # Накопленное отправляем, не дожидаясь следующей рассылки
+        await send_digest(user_id)
+
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Остановить мониторинг"""
     user_id = update.effective_chat.id
@@ -102,20 +211,38 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if awaiting == 'channels':
             # Обработка списка каналов
-            channels = {
+            usernames = {
                 channel.strip() 
                 for channel in update.message.text.split() 
                 if channel.startswith('@')
             }
-            if channels:
+            # Каналы разрешаются в числовые ID один раз, при настройке
+            channels = set()
+            invalid = []
+            try:
+                resolved = [(username, await channel_resolver.resolve(username)) for username in usernames]
+            except ChannelResolveError:
+                await update.message.reply_text(
+                    "Не удалось проверить каналы: Telegram временно недоступен.\n"
+                    "Отправьте список еще раз через несколько минут."
+                )
+                return
+            for username, info in resolved:
+                if info is None:
+                    invalid.append(username)
+                else:
+                    channels.add(info['id'])
+                    storage.set_channel_info(info['id'], info['username'], info['title'])
+            if invalid:
+                await update.message.reply_text(
+                    "Не удалось найти каналы: " + " ".join(sorted(invalid)) + "\n"
+                    "Проверьте названия и отправьте список еще раз."
+                )
+            elif channels:
                 settings = storage.get_user_settings(user_id)
                 settings['channels'] = channels
                 storage.update_user_settings(user_id, settings)
-                await update.message.reply_text(
-                    "Каналы сохранены!\n\n"
-                    "Теперь отправьте ключевые слова в кавычках через пробел.\n"
-                    'Например: "data analyst" "python developer"'
-                )
+                await update.message.reply_text("Каналы сохранены!\n\n" + KEYWORDS_HELP)
                 context.user_data['awaiting_input'] = 'keywords'
             else:
                 await update.message.reply_text(
@@ -125,8 +252,16 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
         elif awaiting == 'keywords':
             # Обработка ключевых слов
-            pattern = r'"([^"]+)"'
-            keywords = set(re.findall(pattern, update.message.text))
+            if is_query(update.message.text):
+                # Запрос с операторами хранится одной строкой в каноническом виде
+                try:
+                    keywords = {format_query(parse_query(update.message.text))}
+                except QuerySyntaxError as e:
+                    await update.message.reply_text(f"Ошибка в запросе: {e}\n\n" + KEYWORDS_HELP)
+                    return
+            else:
+                pattern = r'"([^"]+)"'
+                keywords = set(re.findall(pattern, update.message.text))
             if keywords:
                 settings = storage.get_user_settings(user_id)
                 settings['keywords'] = keywords
@@ -139,6 +274,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "/channels_edit - изменить каналы\n"
                     "/keywords_list - показать ключевые слова\n"
                     "/keywords_edit - изменить ключевые слова\n"
+                    "/digest - получать совпадения сводкой\n"
                     "/stop - остановить мониторинг"
                 )
                 context.user_data.pop('awaiting_input', None)
@@ -151,111 +287,395 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка в обработчике текста: {e}")
         await update.message.reply_text("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-async def forward_formatted_message(message, chat_id):
-    """Форматирование и отправка сообщения пользователю"""
+def get_message_text(message) -> str:
+    """Получение текста или подписи сообщения"""
+    if hasattr(message, 'text') and message.text:
+        return message.text
+    if hasattr(message, 'caption') and message.caption:
+        return message.caption
+    return ""
+
+def get_album_text(messages) -> str:
+    """Объединенная подпись всех сообщений альбома"""
+    return "\n\n".join(
+        text for text in (get_message_text(msg) for msg in messages) if text
+    )
+
+async def fetch_album(message) -> List:
+    """Поиск остальных сообщений альбома, когда событие Album недоступно"""
+    with STAGE_SECONDS.time('fetch'):
+        messages = await client.get_messages(
+            message.chat_id,
+            limit=20,
+            min_id=message.id-10,
+            max_id=message.id+10
+        )
+    album = {
+        msg.id: msg for msg in messages
+        if msg and getattr(msg, 'grouped_id', None) == message.grouped_id
+    }
+    album[message.id] = message
+    return [album[msg_id] for msg_id in sorted(album)]
+
+def format_header(message) -> str:
+    """Заголовок с названием канала и ссылкой на сообщение"""
+    # Сведения о канале сохранены при настройке, сущность чата не запрашиваем
+    info = storage.get_channel_info(message.chat_id)
+    if info is None:
+        chat = getattr(message, 'chat', None)
+        info = {'username': getattr(chat, 'username', None), 'title': getattr(chat, 'title', '')}
+    if info['username']:
+        channel_info = f"Канал: {info['title']} (@{info['username']})"
+        message_link = f"https://t.me/{info['username']}/{message.id}"
+    else:
+        channel_info = f"Канал: {info['title']}"
+        message_link = f"https://t.me/c/{resolve_id(message.chat_id)[0]}/{message.id}"
+    return f"{channel_info}\n{message_link}\n\n"
+
+async def send_cached_media(chat_id, file_ids: List[str], caption: str):
+    """Отправка уже загруженных в Telegram фото по file_id"""
+    if len(file_ids) == 1:
+        await application.bot.send_photo(
+            chat_id=chat_id,
+            photo=file_ids[0],
+            caption=caption
+        )
+    else:
+        await application.bot.send_media_group(
+            chat_id=chat_id,
+            media=[
+                InputMediaPhoto(file_id, caption=caption if i == 0 else None)
+                for i, file_id in enumerate(file_ids)
+            ]
+        )
+
+async def upload_media(message, chat_id, full_text: str, album: Optional[List], cache_key):
+    """Скачивание медиа и первая отправка с сохранением file_id в кэш"""
+    # Если это альбом (карусель)
+    if album or getattr(message, 'grouped_id', None):
+        buffers = []
+        try:
+            if not album:
+                album = await fetch_album(message)
+
+            for msg in album:
+                if hasattr(msg, 'media') and msg.media:
+                    with STAGE_SECONDS.time('download'):
+                        buffer = await download_media_buffer(msg, MEDIA_MEMORY_LIMIT)
+                    if buffer:
+                        buffers.append(buffer)
+
+            # Создаем медиа группу
+            media_group = [
+                InputMediaPhoto(
+                    buffer.input_file(),
+                    caption=full_text if i == 0 else None
+                )
+                for i, buffer in enumerate(buffers)
+            ]
+
+            if media_group:
+                sent_messages = await application.bot.send_media_group(
+                    chat_id=chat_id,
+                    media=media_group
+                )
+                file_ids = [photo_file_id(sent) for sent in sent_messages]
+                if all(file_ids):
+                    media_cache.put(cache_key, file_ids)
+        finally:
+            # Освобождаем буферы и временные файлы
+            for buffer in buffers:
+                buffer.close()
+
+    # Если одиночное сообщение с фото
+    else:
+        with STAGE_SECONDS.time('download'):
+            buffer = await download_media_buffer(message, MEDIA_MEMORY_LIMIT)
+        if buffer is None:
+            # Медиа недоступно для скачивания, отправляем только текст
+            await application.bot.send_message(
+                chat_id=chat_id,
+                text=full_text,
+                disable_web_page_preview=True
+            )
+            return
+
+        try:
+            sent = await application.bot.send_photo(
+                chat_id=chat_id,
+                photo=buffer.input_file(),
+                caption=full_text
+            )
+            file_id = photo_file_id(sent)
+            if file_id:
+                media_cache.put(cache_key, [file_id])
+        finally:
+            buffer.close()
+
+async def forward_formatted_message(message, chat_id, album: Optional[List] = None):
+    """Форматирование и отправка сообщения пользователю.
+
+    album - все сообщения альбома, если они уже собраны событием Album
+    """
     try:
         # Форматируем заголовок сообщения
-        channel_info = f"Канал: {message.chat.title} (@{message.chat.username})"
-        message_link = f"https://t.me/{message.chat.username}/{message.id}"
-        header = f"{channel_info}\n{message_link}\n\n"
+        header = format_header(message)
         
         # Получаем текст сообщения
-        message_text = ""
-        if hasattr(message, 'text') and message.text:
-            message_text = message.text
-        elif hasattr(message, 'caption') and message.caption:
-            message_text = message.caption
-            
-        full_text = header + message_text
-
-        # Если это альбом (карусель)
-        if hasattr(message, 'grouped_id') and message.grouped_id:
-            # Создаем временную директорию
-            temp_dir = 'temp_photos'
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            
-            temp_files = []
-            media_group = []
-            
-            try:
-                # Сначала сохраняем текущее фото
-                if hasattr(message, 'media') and message.media:
-                    temp_path = os.path.join(temp_dir, f"photo_main.jpg")
-                    await message.download_media(temp_path)
-                    temp_files.append(temp_path)
-                
-                # Ищем остальные фото в том же альбоме
-                messages = await client.get_messages(
-                    message.chat_id,
-                    limit=10,
-                    min_id=message.id-10,
-                    max_id=message.id+10
-                )
-                
-                for msg in messages:
-                    if (hasattr(msg, 'grouped_id') and 
-                        msg.grouped_id == message.grouped_id and 
-                        msg.id != message.id and 
-                        hasattr(msg, 'media') and msg.media):
-                        temp_path = os.path.join(temp_dir, f"photo_{msg.id}.jpg")
-                        await msg.download_media(temp_path)
-                        temp_files.append(temp_path)
-                
-                # Создаем медиа группу
-                for i, file_path in enumerate(temp_files):
-                    with open(file_path, 'rb') as photo_file:
-                        if i == 0:
-                            media_group.append(
-                                InputMediaPhoto(
-                                    photo_file.read(),
-                                    caption=full_text
-                                )
-                            )
-                        else:
-                            media_group.append(InputMediaPhoto(photo_file.read()))
-                
-                if media_group:
-                    await application.bot.send_media_group(
-                        chat_id=chat_id,
-                        media=media_group
-                    )
-            finally:
-                # Очищаем временные файлы
-                for file_path in temp_files:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                if os.path.exists(temp_dir) and not os.listdir(temp_dir):
-                    os.rmdir(temp_dir)
-        
-        # Если одиночное сообщение с фото
-        elif hasattr(message, 'media') and message.media:
-            temp_path = 'temp_single.jpg'
-            await message.download_media(temp_path)
-            
-            try:
-                with open(temp_path, 'rb') as photo_file:
-                    await application.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=photo_file.read(),
-                        caption=full_text
-                    )
-            finally:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-        
-        # Если просто текст
+        if album:
+            full_text = header + get_album_text(album)
         else:
+            full_text = header + get_message_text(message)
+
+        is_album = bool(album) or (hasattr(message, 'grouped_id') and message.grouped_id)
+        has_media = hasattr(message, 'media') and message.media
+
+        # Если просто текст
+        if not is_album and not has_media:
             await application.bot.send_message(
                 chat_id=chat_id,
                 text=full_text,
                 disable_web_page_preview=True
             )
+            return
+
+        # Медиа скачивается и загружается один раз, остальные подписчики
+        # получают его по file_id из кэша
+        cache_key = media_cache_key(message)
+        file_ids = media_cache.get(cache_key)
+        if not file_ids:
+            # Блокировка только на скачивание и загрузку, чтобы параллельные
+            # доставки того же сообщения дождались file_id
+            async with media_cache.lock(cache_key):
+                file_ids = media_cache.get(cache_key)
+                if not file_ids:
+                    await upload_media(message, chat_id, full_text, album, cache_key)
+                    return
+        # Копии по file_id отправляются без блокировки, параллельно
+        await send_cached_media(chat_id, file_ids, full_text)
             
     except Exception as e:
         logger.error(f"Ошибка в forward_formatted_message: {e}")
         raise e
 
+async def deliver_job(job: DeliveryJob):
+    """Отправка одной доставки из очереди планировщика"""
+    if job.attempts == 1:
+        # Время от постановки до первой попытки, включая ожидание лимитов
+        STAGE_SECONDS.observe(time.monotonic() - job.enqueued_at, 'queue_wait')
+    with STAGE_SECONDS.time('send'):
+        if job.text is not None:
+            await application.bot.send_message(
+                chat_id=job.user_id,
+                text=job.text,
+                disable_web_page_preview=True
+            )
+        else:
+            await forward_formatted_message(job.message, job.user_id, album=job.album)
+    if not DELIVERY_LOG_SAMPLE:
+        logger.info(f"Сообщение успешно отправлено пользователю {job.user_id}")
+        return
+    # Строка лога форматируется только для каждой N-й доставки при уровне DEBUG
+    number = next(delivery_counter)
+    if number % DELIVERY_LOG_SAMPLE == 0 and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Сообщение успешно отправлено пользователю {job.user_id} (доставка {number})")
+
+async def on_delivery_done(job: DeliveryJob):
+    """Подтверждение доставки в журнале после ответа Bot API"""
+    DELIVERIES.inc('done')
+    if job.outbox_id is not None:
+        outbox.ack(job.outbox_id)
+    if job.digest_ids:
+        digest_buffer.done(job.user_id, job.digest_ids)
+
+async def on_delivery_failed(job: DeliveryJob, error: Exception):
+    """Планирование повтора; ошибки запроса и блокировка бота не повторяются"""
+    DELIVERIES.inc('failed')
+    permanent = isinstance(error, (BadRequest, Forbidden))
+    if job.digest_ids:
+        # Записи неотправленного дайджеста попадут в следующий
+        if permanent:
+            digest_buffer.done(job.user_id, job.digest_ids)
+        else:
+            digest_buffer.release(job.digest_ids)
+    if job.outbox_id is not None:
+        await outbox.fail(job.outbox_id, str(error), permanent=permanent)
+
+# Планировщик доставок между поиском подписчиков и отправкой. С отдельными
+# процессами доставки здесь остаются дайджесты, и лимит делится на N + 1 долю
+delivery_scheduler = DeliveryScheduler(
+    send=deliver_job,
+    on_done=on_delivery_done,
+    on_failed=on_delivery_failed,
+    workers=DELIVERY_WORKERS,
+    queue_size=DELIVERY_QUEUE_SIZE,
+    global_rate=DELIVERY_GLOBAL_RATE / (DELIVERY_PROCESSES + 1),
+    chat_rate=DELIVERY_CHAT_RATE,
+)
+
+def format_digest_entry(message, album: Optional[List] = None) -> str:
+    """Короткая запись о совпадении для дайджеста"""
+    text = get_album_text(album) if album else get_message_text(message)
+    if len(text) > DIGEST_TEXT_LIMIT:
+        text = text[:DIGEST_TEXT_LIMIT].rstrip() + "…"
+    return format_header(message) + text
+
+async def send_digest(user_id: int):
+    """Постановка накопленного дайджеста пользователя в очередь доставки"""
+    entries, dropped = digest_buffer.take(user_id)
+    if not entries:
+        return
+    for text, entry_ids in render_digest(entries, dropped):
+        await delivery_scheduler.submit(DeliveryJob(user_id, None, text=text, digest_ids=entry_ids))
+
+async def run_digests():
+    """Периодическая рассылка дайджестов"""
+    while True:
+        await asyncio.sleep(DIGEST_INTERVAL * 60)
+        users = digest_buffer.users()
+        for user_id in users:
+            try:
+                await send_digest(user_id)
+            except Exception as e:
+                logger.error(f"Ошибка рассылки дайджеста пользователю {user_id}: {e}")
+        if users:
+            logger.info(f"Разосланы дайджесты пользователям: {len(users)}")
+
+async def store_payload(chat_id: int, message, album: Optional[List] = None):
+    """Запись текста и скачанных файлов сообщения для процессов доставки"""
+    if not album and getattr(message, 'grouped_id', None):
+        album = await fetch_album(message)
+    text = format_header(message) + (get_album_text(album) if album else get_message_text(message))
+    paths = []
+    stored = False
+    try:
+        for msg in album or [message]:
+            if getattr(msg, 'media', None):
+                with STAGE_SECONDS.time('download'):
+                    path = await spool_media(msg, SPOOL_DIR)
+                if path:
+                    paths.append(path)
+        stored = await outbox.add_payload(chat_id, message.id, text, paths)
+    finally:
+        # Повторно скачанные файлы уже записанного сообщения не нужны
+        if not stored:
+            for path in paths:
+                os.remove(path)
+
+async def enqueue_deliveries(chat_id: int, message, user_ids: Set[int], album: Optional[List] = None):
+    """Запись доставок в журнал и постановка их в очередь.
+
+    С отдельными процессами доставки задания только записываются в журнал,
+    процессы читают их оттуда сами.
+    """
+    user_ids = delivery_dedup.filter_new(chat_id, message.id, user_ids)
+    if not user_ids:
+        return
+    try:
+        # Пользователи в режиме дайджеста получат сообщение в следующей сводке
+        all_settings = storage.get_all_settings()
+        digest_users = {user_id for user_id in user_ids if all_settings[user_id].get('digest')}
+        if digest_users:
+            entry = format_digest_entry(message, album)
+            for user_id in digest_users:
+                digest_buffer.add(user_id, entry)
+            user_ids = user_ids - digest_users
+            if not user_ids:
+                return
+        grouped_id = message.grouped_id if album else None
+        if DELIVERY_PROCESSES:
+            # Содержимое пишется до заданий, чтобы процесс доставки его нашел
+            await store_payload(chat_id, message, album)
+        with STAGE_SECONDS.time('outbox_write'):
+            job_ids = await outbox.add(chat_id, message.id, user_ids, grouped_id=grouped_id)
+    except Exception:
+        # Доставки не записаны: повтор сообщения из догрузки не должен считаться дубликатом
+        delivery_dedup.forget(chat_id, message.id, user_ids)
+        raise
+    if DELIVERY_PROCESSES:
+        return
+    for user_id, job_id in job_ids.items():
+        await delivery_scheduler.submit(DeliveryJob(user_id, message, album=album, outbox_id=job_id))
+
+async def resubmit_jobs(rows: List[tuple]):
+    """Повторная постановка заданий журнала с загрузкой сообщений из Telegram"""
+    loaded: Dict[tuple, tuple] = {}
+    for job_id, chat_id, message_id, grouped_id, user_id in rows:
+        key = (chat_id, message_id)
+        if key not in loaded:
+            try:
+                with STAGE_SECONDS.time('fetch'):
+                    message = await client.get_messages(chat_id, ids=message_id)
+                album = await fetch_album(message) if message and grouped_id else None
+            except Exception as e:
+                logger.error(f"Не удалось загрузить сообщение {message_id} из {chat_id}: {e}")
+                await outbox.fail(job_id, str(e))
+                continue
+            loaded[key] = (message, album)
+        message, album = loaded[key]
+        if message is None:
+            await outbox.fail(job_id, "Сообщение удалено", permanent=True)
+            continue
+        await delivery_scheduler.submit(DeliveryJob(user_id, message, album=album, outbox_id=job_id))
+
+async def replay_outbox(until_id: int):
+    """Повтор доставок, не завершенных до перезапуска.
+
+    Читаются только задания до until_id: новые сообщения, пришедшие во время
+    повтора, уже поставлены в очередь обработчиками событий.
+    """
+    after_id = 0
+    total = 0
+    while True:
+        rows = await outbox.unfinished(after_id=after_id, until_id=until_id)
+        if not rows:
+            break
+        await resubmit_jobs(rows)
+        after_id = rows[-1][0]
+        total += len(rows)
+    if total:
+        logger.info(f"Повторно поставлено доставок из журнала: {total}")
+
+async def run_outbox_retries():
+    """Периодическая постановка доставок, время повтора которых наступило"""
+    while True:
+        await asyncio.sleep(OUTBOX_RETRY_INTERVAL)
+        try:
+            rows = await outbox.claim_due()
+            if rows:
+                await resubmit_jobs(rows)
+        except Exception as e:
+            logger.error(f"Ошибка повтора доставок: {e}")
+
+async def run_delivery_process(shard: int):
+    """Процесс доставки одной доли подписчиков, перезапускается после выхода.
+
+    Перезапуск процесса доставки не затрагивает соединение Telethon.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+    delay = 1
+    while True:
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, script, '--shard', str(shard), '--shards', str(DELIVERY_PROCESSES)
+        )
+        logger.info(f"Запущен процесс доставки {shard} (pid {process.pid})")
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            raise
+        # Сразу падающий процесс перезапускается с растущей задержкой
+        delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 60)
+        logger.error(f"Процесс доставки {shard} завершился с кодом {code}, перезапуск через {delay} сек")
+        await asyncio.sleep(delay)
+
 async def forward_message_to_subscribers(message):
     """Пересылка сообщения подписчикам"""
     global application, client
@@ -264,48 +684,49 @@ async def forward_message_to_subscribers(message):
             logger.error("Application не инициализирован")
             return
             
-        # Проверяем, что у сообщения есть чат и юзернейм
-        if not hasattr(message, 'chat') or not message.chat or not hasattr(message.chat, 'username'):
+        # Проверяем, что сообщение пришло из чата
+        if not getattr(message, 'chat_id', None):
             logger.info("Пропускаем сообщение без информации о канале")
             return
             
-        # Проверяем каждого пользователя
-        for user_id, settings in storage.get_all_settings().items():
-            if not settings['active']:
-                continue
-                
-            # Проверяем, что сообщение из отслеживаемого канала
-            channel_username = f"@{message.chat.username}"
-            if channel_username not in settings['channels']:
-                continue
-                
-            # Проверяем наличие ключевых слов
-            message_text = ""
-            if hasattr(message, 'text') and message.text:
-                message_text = message.text
-            elif hasattr(message, 'caption') and message.caption:
-                message_text = message.caption
-                
-            if not message_text:
-                logger.info("Пропускаем сообщение без текста")
-                continue
-                
-            if not any(kw.lower() in message_text.lower() for kw in settings['keywords']):
-                continue
-                
-            try:
-                # Форматируем сообщение и отправляем
-                await forward_formatted_message(message, user_id)
-                logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+        message_text = get_message_text(message)
+        if not message_text:
+            logger.info("Пропускаем сообщение без текста")
+            return
+
+        # Один проход по тексту находит всех подходящих подписчиков канала
+        MESSAGES.inc()
+        with STAGE_SECONDS.time('match'):
+            user_ids = storage.match_channel(message.chat_id, message_text)
+        await enqueue_deliveries(message.chat_id, message, user_ids)
                 
     except Exception as e:
         logger.error(f"Ошибка в forward_message_to_subscribers: {e}")
 
+async def dispatch_channel_message(chat_id: int, message, album: Optional[List] = None):
+    """Поиск подписчиков для сообщения или альбома канала и доставка"""
+    # Один проход по тексту находит всех подходящих подписчиков канала
+    if album:
+        message_text = get_album_text(album)
+    else:
+        message_text = get_message_text(message)
+    MESSAGES.inc()
+    with STAGE_SECONDS.time('match'):
+        user_ids = storage.match_channel(chat_id, message_text)
+    await enqueue_deliveries(chat_id, message, user_ids, album=album)
+    
+    # Сообщение записано в журнал, теперь его можно считать обработанным
+    mark = high_water_marks.get(chat_id)
+    last_id = max(msg.id for msg in album) if album else message.id
+    high_water_marks.advance(chat_id, last_id)
+    
+    # Пропуск в ID означает, что часть сообщений не пришла обновлениями
+    if mark is not None and message.id > mark + 1 and channel_catchup is not None:
+        channel_catchup.schedule(chat_id, min_id=mark, max_id=message.id)
+
 async def main():
     """Основная функция запуска бота"""
-    global application, client
+    global application, client, watch_set, channel_resolver, channel_catchup
     
     # Инициализация бота
     application = Application.builder().token(BOT_TOKEN).build()
@@ -319,48 +740,152 @@ async def main():
     application.add_handler(CommandHandler("channels_edit", channels_edit))
     application.add_handler(CommandHandler("keywords_list", keywords_list))
     application.add_handler(CommandHandler("keywords_edit", keywords_edit))
+    application.add_handler(CommandHandler("digest", digest))
     application.add_handler(CommandHandler("stop", stop))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
+    if DEDUP_FILE:
+        delivery_dedup.load(DEDUP_FILE)
+    
     # Запускаем клиент Telethon
     await client.start()
+    # Bot API должен быть готов до первой доставки из журнала
+    await application.initialize()
+    delivery_scheduler.start()
+    storage.start()
+    outbox.start()
+    high_water_marks.start()
+    digest_buffer.start()
+    
+    # Старые настройки с @username переводим на числовые ID каналов
+    channel_resolver = ChannelResolver(client, cache_size=CHANNEL_CACHE_SIZE)
+    await migrate_legacy_channels(storage, channel_resolver)
+    
+    # События из чатов, которые никто не отслеживает, отбрасываются по chat_id
+    watch_set = ChannelWatchSet(
+        client,
+        storage,
+        join_channels=WATCH_JOIN_CHANNELS,
+        leave_channels=WATCH_LEAVE_CHANNELS
+    )
+    watch_set.start()
+    
+    # Отметки каналов без подписчиков сбрасываются, чтобы повторная подписка
+    # не догружала старые посты
+    high_water_marks.forget(set(high_water_marks.marks) - set(watch_set.watched_ids))
+    storage.add_channels_listener(lambda added, removed: high_water_marks.forget(removed))
+    
+    # Метрики: гистограммы этапов обновляются по ходу работы, остальное читается при запросе
+    REGISTRY.register(Gauge(
+        'watcher_active_users', "Активные пользователи",
+        lambda: sum(1 for settings in storage.get_all_settings().values() if settings['active'])
+    ))
+    REGISTRY.register(Gauge(
+        'watcher_watched_channels', "Отслеживаемые каналы", lambda: len(watch_set.watched_ids)
+    ))
+    REGISTRY.register(Gauge(
+        'watcher_delivery_queue', "Доставки в очереди", lambda: delivery_scheduler.pending
+    ))
+    metrics_server = None
+    if METRICS_PORT:
+        try:
+            metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик: {e}")
+    
+    # Граница повтора журнала: задания после нее создадут обработчики событий
+    replay_until_id = await outbox.last_id()
     
     # Добавляем обработчик новых сообщений
-    @client.on(events.NewMessage())
+    @client.on(events.NewMessage(func=watch_set.is_watched))
     async def handle_new_message(event):
         try:
-            # Получаем информацию о чате
-            chat = await event.get_chat()
-            if not hasattr(chat, 'username'):
+            # Сообщения альбома обрабатываются один раз в handle_album
+            if event.message.grouped_id:
                 return
                 
-            channel_username = f"@{chat.username}"
-            
-            # Проверяем все активные подписки
-            for user_id, settings in storage.get_all_settings().items():
-                if not settings.get('active', False):
-                    continue
-                    
-                if channel_username not in settings.get('channels', set()):
-                    continue
-                    
-                # Получаем текст сообщения
-                message_text = ""
-                if event.message.text:
-                    message_text = event.message.text
-                elif event.message.caption:
-                    message_text = event.message.caption
-                
-                # Проверяем наличие ключевых слов
-                if any(keyword.lower() in message_text.lower() 
-                       for keyword in settings.get('keywords', set())):
-                    await forward_formatted_message(event.message, user_id)
+            await dispatch_channel_message(event.chat_id, event.message)
                     
         except Exception as e:
             logger.error(f"Ошибка при обработке нового сообщения: {e}")
     
-    # Запускаем бота
-    await application.run_polling()
+    # Альбом приходит одним событием со всеми сообщениями группы
+    @client.on(events.Album(func=watch_set.is_watched))
+    async def handle_album(event):
+        try:
+            await dispatch_channel_message(event.chat_id, event.messages[0], album=event.messages)
+            
+        except Exception as e:
+            logger.error(f"Ошибка при обработке альбома: {e}")
+    
+    if DELIVERY_PROCESSES:
+        # Журнал читают процессы доставки, здесь остаются дайджесты и ответы на команды
+        delivery_tasks = [
+            asyncio.create_task(run_delivery_process(shard), name=f"delivery-process-{shard}")
+            for shard in range(DELIVERY_PROCESSES)
+        ]
+    else:
+        # Доставки, не завершенные до перезапуска, ставим в очередь заново
+        await replay_outbox(replay_until_id)
+        delivery_tasks = [asyncio.create_task(run_outbox_retries(), name="outbox-retries")]
+    digest_task = asyncio.create_task(run_digests(), name="digests")
+    
+    # Сообщения, опубликованные пока бот не работал, догружаем в фоне
+    channel_catchup = ChannelCatchUp(
+        client,
+        high_water_marks,
+        dispatch_channel_message,
+        concurrency=CATCHUP_CONCURRENCY,
+        limit=CATCHUP_LIMIT
+    )
+    catchup_task = asyncio.create_task(
+        channel_catchup.catch_up(watch_set.watched_ids), name="channel-catchup"
+    )
+    
+    # Запускаем бота и работаем до сигнала остановки или отключения Telethon
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows не поддерживает обработчики сигналов в event loop
+            pass
+    
+    async with application:
+        await application.start()
+        await application.updater.start_polling()
+        try:
+            await asyncio.wait(
+                [asyncio.ensure_future(stop_event.wait()), client.disconnected],
+                return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            logger.info("Останавливаем бота")
+            await application.updater.stop()
+            await application.stop()
+            await watch_set.stop()
+            if metrics_server is not None:
+                metrics_server.close()
+            for task in delivery_tasks:
+                task.cancel()
+            await asyncio.gather(*delivery_tasks, return_exceptions=True)
+            digest_task.cancel()
+            catchup_task.cancel()
+            await channel_catchup.stop()
+            # Недоставленное останется в журнале и будет повторено при запуске
+            await delivery_scheduler.stop(drain=False)
+            await outbox.close()
+            await high_water_marks.close()
+            await digest_buffer.close()
+            if DEDUP_FILE:
+                try:
+                    delivery_dedup.save(DEDUP_FILE)
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения кэша дубликатов: {e}")
+            # Гарантированная запись отложенных изменений настроек
+            await storage.close()
+            await client.disconnect()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
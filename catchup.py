@@ -0,0 +1,195 @@
+import asyncio
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+import logging
+
+logger = logging.getLogger(__name__)
+
+class HighWaterMarks:
+    """Последний обработанный ID сообщения по каждому каналу.
+
+    Значения держатся в памяти и сбрасываются в SQLite пачкой в фоне.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS high_water_marks (
+            chat_id INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, filename: str, flush_interval: float = 5.0):
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        self.marks: Dict[int, int] = dict(
+            self.conn.execute("SELECT chat_id, message_id FROM high_water_marks")
+        )
+        self._dirty: Set[int] = set()
+        self._deleted: Set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def get(self, chat_id: int) -> Optional[int]:
+        return self.marks.get(chat_id)
+
+    def advance(self, chat_id: int, message_id: int) -> None:
+        """Сдвиг отметки вперед; более старые ID ее не меняют"""
+        if message_id > self.marks.get(chat_id, 0):
+            self.marks[chat_id] = message_id
+            self._dirty.add(chat_id)
+            self._deleted.discard(chat_id)
+
+    def forget(self, chat_ids: Iterable[int]) -> None:
+        """Удаление отметок каналов, которые больше не отслеживаются.
+
+        Иначе при повторной подписке через долгое время первое же сообщение
+        выглядело бы пропуском и догружало старые посты новым подписчикам.
+        """
+        for chat_id in chat_ids:
+            if self.marks.pop(chat_id, None) is not None:
+                self._dirty.discard(chat_id)
+                self._deleted.add(chat_id)
+
+    def _write(self, rows: List[tuple], deleted: List[int]) -> None:
+        with self._conn_lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO high_water_marks (chat_id, message_id) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET message_id = MAX(message_id, excluded.message_id)",
+                rows
+            )
+            self.conn.executemany(
+                "DELETE FROM high_water_marks WHERE chat_id = ?", [(chat_id,) for chat_id in deleted]
+            )
+
+    async def flush(self) -> None:
+        if not self._dirty and not self._deleted:
+            return
+        dirty, self._dirty = self._dirty, set()
+        deleted, self._deleted = self._deleted, set()
+        rows = [(chat_id, self.marks[chat_id]) for chat_id in dirty]
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, rows, list(deleted))
+        except Exception as e:
+            self._dirty |= dirty
+            self._deleted |= deleted - set(self.marks)
+            logger.error(f"Ошибка сохранения отметок каналов: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="high-water-marks")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        with self._conn_lock:
+            self.conn.close()
+
+class ChannelCatchUp:
+    """Догрузка сообщений, пропущенных за время простоя или разрыва соединения.
+
+    Для каждого канала читаются сообщения новее отметки, но не больше
+    limit последних, и передаются в тот же путь поиска и доставки.
+    """
+
+    def __init__(
+        self,
+        client,
+        marks: HighWaterMarks,
+        dispatch: Callable[[int, object, Optional[List]], Awaitable[None]],
+        concurrency: int = 4,
+        limit: int = 100,
+    ):
+        self.client = client
+        self.marks = marks
+        self.dispatch = dispatch
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Каналы, для которых догрузка уже идет
+        self._running: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def catch_up(self, chat_ids: Iterable[int]) -> None:
+        """Догрузка нескольких каналов с ограничением параллельности"""
+        # Отметки читаются сразу: живые сообщения могут сдвинуть их во время догрузки
+        starts = {chat_id: self.marks.get(chat_id) for chat_id in chat_ids}
+        await asyncio.gather(*(
+            self.catch_up_channel(chat_id, min_id=min_id)
+            for chat_id, min_id in starts.items()
+        ))
+
+    def schedule(self, chat_id: int, min_id: int, max_id: int = 0) -> None:
+        """Фоновая догрузка диапазона, например при обнаружении пропуска ID"""
+        if chat_id in self._running:
+            return
+        task = asyncio.create_task(self.catch_up_channel(chat_id, min_id=min_id, max_id=max_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def catch_up_channel(self, chat_id: int, min_id: Optional[int], max_id: int = 0) -> None:
+        """Догрузка сообщений канала с ID в интервале (min_id, max_id)"""
+        if chat_id in self._running:
+            return
+        self._running.add(chat_id)
+        try:
+            async with self._semaphore:
+                await self._catch_up_channel(chat_id, min_id, max_id)
+        except Exception as e:
+            logger.error(f"Ошибка догрузки канала {chat_id}: {e}")
+        finally:
+            self._running.discard(chat_id)
+
+    async def _catch_up_channel(self, chat_id: int, mark: Optional[int], max_id: int) -> None:
+        if mark is None:
+            # Новый канал: историю не рассылаем, только запоминаем последнее сообщение
+            latest = await self.client.get_messages(chat_id, limit=1)
+            if latest:
+                self.marks.advance(chat_id, latest[0].id)
+            return
+
+        # Берем самые новые сообщения после отметки, не больше limit
+        messages = [
+            message async for message in self.client.iter_messages(
+                chat_id, min_id=mark, max_id=max_id, limit=self.limit
+            )
+        ]
+        if not messages:
+            return
+        messages.reverse()
+        skipped = messages[0].id - mark - 1
+        if len(messages) == self.limit and skipped > 0:
+            logger.warning(f"Канал {chat_id}: пропущено до {skipped} старых сообщений сверх лимита догрузки")
+
+        for group in group_albums(messages):
+            if len(group) > 1 or getattr(group[0], 'grouped_id', None):
+                await self.dispatch(chat_id, group[0], group)
+            else:
+                await self.dispatch(chat_id, group[0], None)
+        logger.info(f"Канал {chat_id}: догружено сообщений {len(messages)}")
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+def group_albums(messages: List) -> List[List]:
+    """Объединение подряд идущих сообщений одного альбома"""
+    groups: List[List] = []
+    for message in messages:
+        grouped_id = getattr(message, 'grouped_id', None)
+        if grouped_id and groups and getattr(groups[-1][0], 'grouped_id', None) == grouped_id:
+            groups[-1].append(message)
+        else:
+            groups.append([message])
+    return groups
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from typing import Dict, Optional
+import logging
+from telethon.errors import BadRequestError
+from telethon.tl.types import Channel
+from telethon.utils import get_peer_id
+
+logger = logging.getLogger(__name__)
+
+class ChannelResolveError(Exception):
+    """Временная ошибка разрешения канала (FloodWait, сеть); повторить позже"""
+
+class ChannelResolver:
+    """Разрешение @username канала в числовой peer ID через Telethon.
+
+    Результаты кэшируются в ограниченном LRU, чтобы повторные настройки
+    популярных каналов не обращались к сети.
+    """
+
+    def __init__(self, client, cache_size: int = 1000):
+        self.client = client
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Dict]" = OrderedDict()
+
+    async def resolve(self, username: str) -> Optional[Dict]:
+        """Информация о канале или None, если это не канал или он не найден.
+
+        Временные ошибки не означают, что канала нет, и поднимают ChannelResolveError.
+        """
+        key = username.lstrip('@').lower()
+        if not key:
+            return None
+        info = self._cache.get(key)
+        if info is not None:
+            self._cache.move_to_end(key)
+            return info
+
+        try:
+            entity = await self.client.get_entity(key)
+        except (ValueError, TypeError, BadRequestError) as e:
+            # Telethon сообщает о несуществующем username через ValueError,
+            # о неверном или закрытом - ошибками запроса 400
+            logger.info(f"Канал @{key} не найден: {e}")
+            return None
+        except Exception as e:
+            logger.warning(f"Не удалось разрешить @{key}: {e}")
+            raise ChannelResolveError(str(e)) from e
+        if not isinstance(entity, Channel):
+            logger.info(f"@{key} не является каналом")
+            return None
+
+        info = {
+            'id': get_peer_id(entity),
+            'username': entity.username,
+            'title': entity.title,
+        }
+        self._cache[key] = info
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return info
+
+async def migrate_legacy_channels(storage, resolver: ChannelResolver) -> int:
+    """Замена сохраненных @username на числовые ID каналов.
+
+    Возвращает число обновленных пользователей. Каналы, которых точно нет,
+    удаляются из настроек. При временной ошибке перенос останавливается,
+    оставшиеся @username сохраняются и переносятся при следующем запуске.
+    """
+    updated = 0
+    interrupted = False
+    for user_id, settings in list(storage.get_all_settings().items()):
+        if interrupted:
+            break
+        legacy = {channel for channel in settings['channels'] if isinstance(channel, str)}
+        if not legacy:
+            continue
+        channels = set(settings['channels']) - legacy
+        for username in legacy:
+            if interrupted:
+                channels.add(username)
+                continue
+            try:
+                info = await resolver.resolve(username)
+            except ChannelResolveError as e:
+                logger.warning(f"Перенос каналов прерван ({e}), продолжим при следующем запуске")
+                interrupted = True
+                channels.add(username)
+                continue
+            if info is None:
+                logger.warning(f"Канал {username} пользователя {user_id} не найден и удален")
+                continue
+            storage.set_channel_info(info['id'], info['username'], info['title'])
+            channels.add(info['id'])
+        settings['channels'] = channels
+        storage.update_user_settings(user_id, settings)
+        updated += 1
+    if updated:
+        logger.info(f"Каналы переведены на числовые ID для {updated} пользователей")
+    return updated
@@ -0,0 +1,84 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Iterable, Set, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DeliveryDedup:
+    """Ограниченный по размеру и времени жизни кэш уже поставленных доставок.
+
+    Ключ верхнего уровня - (chat_id, message_id), внутри хранится множество
+    подписчиков. Повторная обработка сообщения из другого обработчика,
+    после переподключения или догрузки сводится к поиску в словаре.
+    """
+
+    def __init__(self, max_messages: int = 10000, ttl: float = 86400):
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[float, Set[int]]]" = OrderedDict()
+
+    def filter_new(self, chat_id: int, message_id: int, user_ids: Iterable[int]) -> Set[int]:
+        """Подписчики, которым сообщение еще не ставилось; они сразу запоминаются"""
+        key = (chat_id, message_id)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None or now - entry[0] > self.ttl:
+            # Запись переносится в конец, порядок остается порядком времени
+            self._entries.pop(key, None)
+            entry = (now, set())
+            self._entries[key] = entry
+        seen = entry[1]
+        new_users = set(user_ids) - seen
+        seen |= new_users
+        self._evict(now)
+        return new_users
+
+    def forget(self, chat_id: int, message_id: int, user_ids: Iterable[int]) -> None:
+        """Отмена запоминания подписчиков, если их доставки не удалось записать"""
+        entry = self._entries.get((chat_id, message_id))
+        if entry is not None:
+            entry[1].difference_update(user_ids)
+
+    def _evict(self, now: float) -> None:
+        while len(self._entries) > self.max_messages:
+            self._entries.popitem(last=False)
+        # Записи добавляются по времени, поэтому устаревшие лежат в начале
+        while self._entries:
+            key, (stored_at, _) = next(iter(self._entries.items()))
+            if now - stored_at <= self.ttl:
+                break
+            del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def save(self, filename: str) -> None:
+        """Сохранение кэша, чтобы подавлять дубликаты и после перезапуска"""
+        data = [
+            [chat_id, message_id, stored_at, sorted(users)]
+            for (chat_id, message_id), (stored_at, users) in self._entries.items()
+        ]
+        temp_path = f"{filename}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp_path, filename)
+
+    def load(self, filename: str) -> None:
+        """Загрузка кэша, сохраненного при прошлой остановке"""
+        if not os.path.exists(filename):
+            return
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша дубликатов: {e}")
+            return
+        now = time.time()
+        for chat_id, message_id, stored_at, users in data:
+            if now - stored_at <= self.ttl:
+                self._entries[(chat_id, message_id)] = (stored_at, set(users))
+        self._evict(now)
+        logger.info(f"Загружено сообщений в кэш дубликатов: {len(self._entries)}")
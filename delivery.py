@@ -0,0 +1,236 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+import logging
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds: float) -> None:
+        """Запрет отправки на время, указанное Telegram в RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def is_idle(self) -> bool:
+        """Корзина полна и не на паузе, ее можно удалить без потери состояния"""
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._paused_until
+
+    async def acquire(self) -> None:
+        """Ожидание свободного токена"""
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class DeliveryJob:
+    """Доставка одного сообщения (или альбома) одному подписчику"""
+
+    def __init__(
+        self,
+        user_id: int,
+        message,
+        album: Optional[List] = None,
+        outbox_id: Optional[int] = None,
+        text: Optional[str] = None,
+        digest_ids: Optional[List[int]] = None,
+    ):
+        self.user_id = user_id
+        self.message = message
+        self.album = album
+        # Номер задания в журнале доставок, если он используется
+        self.outbox_id = outbox_id
+        # Готовый текст вместо сообщения канала и записи дайджеста в нем
+        self.text = text
+        self.digest_ids = digest_ids
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+class DeliveryScheduler:
+    """Очередь доставок с пулом воркеров и ограничением скорости Bot API.
+
+    Ограниченная очередь создает обратное давление: когда воркеры не
+    успевают, submit() ждет и тем самым тормозит прием новых сообщений.
+
+    Задания одного чата выполняет один воркер по порядку: остальные задания
+    этого чата ждут в его очереди, а свободные воркеры берут другие чаты.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[DeliveryJob], Awaitable[None]],
+        on_done: Optional[Callable[[DeliveryJob], Awaitable[None]]] = None,
+        on_failed: Optional[Callable[[DeliveryJob, Exception], Awaitable[None]]] = None,
+        workers: int = 8,
+        queue_size: int = 1000,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 3,
+        max_retries: int = 3,
+        flood_retry_after: float = 10,
+        flood_chats: int = 3,
+        flood_window: float = 1,
+    ):
+        self._send = send
+        self._on_done = on_done
+        self._on_failed = on_failed
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        # Когда RetryAfter похож на общий лимит бота, пауза ставится всем чатам:
+        # долгая пауза или flood_chats разных чатов за flood_window секунд
+        self.flood_retry_after = flood_retry_after
+        self.flood_chats = flood_chats
+        self.flood_window = flood_window
+        self._recent_floods: "deque[tuple]" = deque()
+        self._queue: "asyncio.Queue[DeliveryJob]" = asyncio.Queue()
+        # Ограничение числа заданий в очереди и в очередях чатов вместе
+        self._slots = asyncio.Semaphore(queue_size)
+        self._pending = 0
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        # Чаты, которые сейчас обслуживает воркер, и их отложенные задания
+        self._chat_backlogs: Dict[int, "deque[DeliveryJob]"] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Запуск воркеров в текущем event loop"""
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"delivery-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Запущено воркеров доставки: {self.workers}")
+
+    async def stop(self, drain: bool = True) -> None:
+        """Остановка воркеров, по умолчанию после опустошения очереди"""
+        if drain and self._tasks:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def submit(self, job: DeliveryJob) -> None:
+        """Постановка доставки в очередь, ждет при переполнении"""
+        await self._slots.acquire()
+        self._pending += 1
+        self._queue.put_nowait(job)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._prune_chats()
+            bucket = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_chats(self) -> None:
+        """Удаление состояния чатов, которые давно ничего не получали"""
+        for chat_id in list(self._chat_buckets):
+            if self._chat_buckets[chat_id].is_idle() and chat_id not in self._chat_backlogs:
+                del self._chat_buckets[chat_id]
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            chat_id = job.user_id
+            backlog = self._chat_backlogs.get(chat_id)
+            if backlog is not None:
+                # Чат занят другим воркером: задание ждет своей очереди в нем,
+                # а этот воркер берет следующее
+                backlog.append(job)
+                continue
+            backlog = self._chat_backlogs[chat_id] = deque()
+            try:
+                while True:
+                    await self._process(job)
+                    if not backlog:
+                        break
+                    job = backlog.popleft()
+            finally:
+                del self._chat_backlogs[chat_id]
+
+    async def _process(self, job: DeliveryJob) -> None:
+        try:
+            await self._deliver(job)
+            if self._on_done is not None:
+                await self._on_done(job)
+        except Exception as e:
+            logger.error(f"Ошибка доставки пользователю {job.user_id}: {e}")
+            if self._on_failed is not None:
+                try:
+                    await self._on_failed(job, e)
+                except Exception as callback_error:
+                    logger.error(f"Ошибка обработки неудачной доставки: {callback_error}")
+        finally:
+            self._pending -= 1
+            self._slots.release()
+            self._queue.task_done()
+
+    def _on_flood(self, chat_id: int, retry_after: float) -> None:
+        """Пауза общего лимита, если RetryAfter пришел не из-за одного чата"""
+        now = time.monotonic()
+        self._recent_floods.append((now, chat_id))
+        while self._recent_floods and now - self._recent_floods[0][0] > self.flood_window:
+            self._recent_floods.popleft()
+        chats = {flood_chat for _, flood_chat in self._recent_floods}
+        if retry_after >= self.flood_retry_after or len(chats) >= self.flood_chats:
+            logger.warning(f"Flood limit у {len(chats)} чатов, пауза всех доставок {retry_after} сек")
+            self._global_bucket.pause(retry_after)
+
+    async def _deliver(self, job: DeliveryJob) -> None:
+        # Задания чата выполняются одним воркером, порядок сообщений сохраняется
+        bucket = self._chat_bucket(job.user_id)
+        while True:
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            job.attempts += 1
+            try:
+                await self._send(job)
+                return
+            except RetryAfter as e:
+                # Ожидание по RetryAfter не считается неудачной попыткой
+                retry_after = float(e.retry_after)
+                logger.warning(f"Flood limit для {job.user_id}, пауза {retry_after} сек")
+                bucket.pause(retry_after)
+                self._on_flood(job.user_id, retry_after)
+                job.attempts -= 1
+            except BadRequest:
+                # BadRequest наследует NetworkError, но повтор не поможет
+                raise
+            except NetworkError as e:
+                if job.attempts > self.max_retries:
+                    raise
+                delay = 2 ** job.attempts
+                logger.warning(f"Сетевая ошибка доставки {job.user_id}: {e}, повтор через {delay} сек")
+                await asyncio.sleep(delay)
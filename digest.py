@@ -0,0 +1,165 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram ограничивает длину сообщения 4096 символами
+MESSAGE_LIMIT = 4000
+
+class DigestBuffer:
+    """Совпадения пользователей в режиме дайджеста до следующей рассылки.
+
+    Записи держатся в памяти, не больше max_items на пользователя, и
+    сбрасываются в SQLite пачкой в фоне, поэтому переживают перезапуск.
+    Запись удаляется только после успешной отправки дайджеста.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS digest_entries (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            added_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, filename: str, max_items: int = 50, flush_interval: float = 5.0):
+        self.max_items = max_items
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        # Пользователь -> id записи -> текст
+        self._entries: Dict[int, "OrderedDict[int, str]"] = {}
+        for entry_id, user_id, text in self.conn.execute(
+            "SELECT id, user_id, text FROM digest_entries ORDER BY id"
+        ):
+            self._entries.setdefault(user_id, OrderedDict())[entry_id] = text
+        self._next_id = max(
+            (max(entries) for entries in self._entries.values()), default=0
+        ) + 1
+        # Совпадения, не попавшие в буфер из-за ограничения размера
+        self._dropped: Dict[int, int] = {}
+        # Записи в уже отправляемых дайджестах
+        self._in_flight: Set[int] = set()
+        self._inserts: List[Tuple[int, int, str, float]] = []
+        self._deletes: List[int] = []
+        self._task: Optional[asyncio.Task] = None
+        if self._entries:
+            logger.info(f"Загружено записей дайджестов: {sum(map(len, self._entries.values()))}")
+
+    def add(self, user_id: int, text: str) -> None:
+        """Добавление совпадения; при переполнении теряется самое старое"""
+        entries = self._entries.setdefault(user_id, OrderedDict())
+        entry_id = self._next_id
+        self._next_id += 1
+        entries[entry_id] = text
+        self._inserts.append((entry_id, user_id, text, time.time()))
+        if len(entries) > self.max_items:
+            for old_id in entries:
+                if old_id not in self._in_flight:
+                    del entries[old_id]
+                    self._deletes.append(old_id)
+                    self._dropped[user_id] = self._dropped.get(user_id, 0) + 1
+                    break
+
+    def users(self) -> List[int]:
+        """Пользователи, у которых есть неотправленные записи"""
+        return [
+            user_id for user_id, entries in self._entries.items()
+            if any(entry_id not in self._in_flight for entry_id in entries)
+        ]
+
+    def take(self, user_id: int) -> Tuple[List[Tuple[int, str]], int]:
+        """Записи для дайджеста и число потерянных совпадений.
+
+        Записи помечаются отправляемыми до вызова done() или release().
+        """
+        entries = [
+            (entry_id, text)
+            for entry_id, text in self._entries.get(user_id, {}).items()
+            if entry_id not in self._in_flight
+        ]
+        self._in_flight.update(entry_id for entry_id, _ in entries)
+        return entries, self._dropped.pop(user_id, 0)
+
+    def done(self, user_id: int, entry_ids: List[int]) -> None:
+        """Удаление записей после успешной отправки"""
+        entries = self._entries.get(user_id, {})
+        for entry_id in entry_ids:
+            self._in_flight.discard(entry_id)
+            if entries.pop(entry_id, None) is not None:
+                self._deletes.append(entry_id)
+        if not entries:
+            self._entries.pop(user_id, None)
+
+    def release(self, entry_ids: List[int]) -> None:
+        """Возврат записей неудачной отправки в следующий дайджест"""
+        self._in_flight.difference_update(entry_ids)
+
+    def _write(self, inserts: List[tuple], deletes: List[int]) -> None:
+        with self._conn_lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO digest_entries (id, user_id, text, added_at) VALUES (?, ?, ?, ?)",
+                inserts
+            )
+            self.conn.executemany("DELETE FROM digest_entries WHERE id = ?", [(entry_id,) for entry_id in deletes])
+
+    async def flush(self) -> None:
+        if not self._inserts and not self._deletes:
+            return
+        inserts, self._inserts = self._inserts, []
+        deletes, self._deletes = self._deletes, []
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, inserts, deletes)
+        except Exception as e:
+            self._inserts = inserts + self._inserts
+            self._deletes = deletes + self._deletes
+            logger.error(f"Ошибка сохранения дайджестов: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="digest-buffer")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        with self._conn_lock:
+            self.conn.close()
+
+def render_digest(entries: List[Tuple[int, str]], dropped: int = 0) -> List[Tuple[str, List[int]]]:
+    """Сборка записей в несколько сообщений не длиннее лимита Telegram.
+
+    Возвращает пары (текст сообщения, id вошедших в него записей).
+    """
+    title = f"Дайджест: совпадений {len(entries) + dropped}"
+    if dropped:
+        title += f", из них не сохранено из-за лимита: {dropped}"
+    messages = []
+    text = title
+    entry_ids: List[int] = []
+    for entry_id, entry in entries:
+        entry = entry[:MESSAGE_LIMIT // 2]
+        if entry_ids and len(text) + len(entry) + 2 > MESSAGE_LIMIT:
+            messages.append((text, entry_ids))
+            text, entry_ids = "", []
+        text = f"{text}\n\n{entry}" if text else entry
+        entry_ids.append(entry_id)
+    if entry_ids:
+        messages.append((text, entry_ids))
+    return messages
@@ -0,0 +1,275 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set, Tuple
+import logging
+from query import QuerySyntaxError, parse_query
+
+logger = logging.getLogger(__name__)
+
+def normalize_text(text: str) -> str:
+    """Нормализация текста перед поиском ключевых слов.
+
+    Регистр сворачивается через casefold, ё приравнивается к е, а любые
+    последовательности пробельных символов заменяются одним пробелом.
+    """
+    return ' '.join(text.casefold().replace('ё', 'е').split())
+
+def is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+# Виды узлов плана вычисления запросов
+TERM, NOT, AND, OR = range(4)
+
+class KeywordMatcher:
+    """Автомат Ахо-Корасик по объединению ключевых слов подписчиков канала.
+
+    Текст сообщения сканируется один раз, результатом является множество
+    пользователей, у которых нашлось хотя бы одно ключевое слово.
+
+    Ключевое слово в кавычках с операторами - запрос (см. query.py). Фразы
+    всех запросов канала попадают в тот же автомат и проверяются по
+    границам слов, а сами запросы собираются в общий план, где одинаковые
+    подвыражения разных пользователей вычисляются один раз на сообщение.
+    """
+
+    def __init__(self, keywords_by_user: Dict[int, Iterable[str]]):
+        # Переходы, суффиксные ссылки и номера шаблонов для каждого узла
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        # Номер шаблона -> пользователи с этим ключевым словом
+        self._pattern_users: List[Set[int]] = []
+        self._pattern_lengths: List[int] = []
+        # Номер шаблона -> фразы запросов: целое слово и начало слова
+        self._pattern_word_terms: List[int] = []
+        self._pattern_prefix_terms: List[int] = []
+        # Узлы автомата, где заканчиваются фразы запросов
+        self._term_nodes: Set[int] = set()
+        # Пользователи с пустым ключевым словом совпадают с любым текстом
+        self._always: Set[int] = set()
+
+        # План: узлы (вид, аргументы) с общими подвыражениями
+        self._nodes: List[tuple] = []
+        self._node_ids: Dict[tuple, int] = {}
+        self._term_count = 0
+        # Корень запроса -> пользователи; фраза -> корни, где она встречается
+        self._root_users: Dict[int, Set[int]] = {}
+        self._term_roots: Dict[int, Set[int]] = {}
+        # Запросы, которые истинны и без единой найденной фразы (например, NOT "x")
+        self._always_roots: Set[int] = set()
+
+        self._patterns: Dict[str, int] = {}
+        for user_id, keywords in keywords_by_user.items():
+            for keyword in keywords:
+                if '"' in keyword:
+                    self._add_query(user_id, keyword)
+                    continue
+                keyword = normalize_text(keyword)
+                if not keyword:
+                    self._always.add(user_id)
+                    continue
+                self._pattern_users[self._pattern_id(keyword)].add(user_id)
+
+        self._build_links()
+        self._build_roots()
+        del self._patterns
+
+    def _pattern_id(self, pattern: str) -> int:
+        pattern_id = self._patterns.get(pattern)
+        if pattern_id is None:
+            pattern_id = len(self._pattern_users)
+            self._patterns[pattern] = pattern_id
+            self._pattern_users.append(set())
+            self._pattern_lengths.append(len(pattern))
+            self._pattern_word_terms.append(-1)
+            self._pattern_prefix_terms.append(-1)
+            self._add_pattern(pattern, pattern_id)
+        return pattern_id
+
+    def _add_pattern(self, pattern: str, pattern_id: int) -> None:
+        """Добавление шаблона в бор"""
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][char] = next_node
+            node = next_node
+        self._out[node].append(pattern_id)
+
+    def _build_links(self) -> None:
+        """Построение суффиксных ссылок обходом в ширину"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                # Наследуем совпадения более коротких суффиксов
+                self._out[child].extend(self._out[self._fail[child]])
+                if self._fail[child] in self._term_nodes:
+                    self._term_nodes.add(child)
+
+    def _add_query(self, user_id: int, text: str) -> None:
+        try:
+            query = parse_query(text)
+        except QuerySyntaxError as e:
+            logger.warning(f"Запрос пользователя {user_id} не разобран ({e}), ищем его как фразу")
+            normalized = normalize_text(text)
+            if normalized:
+                self._pattern_users[self._pattern_id(normalized)].add(user_id)
+            return
+        root = self._compile(query)
+        self._root_users.setdefault(root, set()).add(user_id)
+
+    def _node(self, key: tuple) -> int:
+        """Номер узла плана; одинаковые подвыражения получают один номер"""
+        node_id = self._node_ids.get(key)
+        if node_id is None:
+            node_id = len(self._nodes)
+            self._node_ids[key] = node_id
+            self._nodes.append(key)
+        return node_id
+
+    def _compile(self, query: tuple) -> int:
+        kind = query[0]
+        if kind == 'term':
+            return self._node((TERM, self._term_id(query[1], query[2])))
+        if kind == 'not':
+            return self._node((NOT, self._compile(query[1])))
+        op = AND if kind == 'and' else OR
+        children = set()
+        for child in query[1]:
+            child_id = self._compile(child)
+            # Вложенные AND в AND и OR в OR раскрываются
+            if self._nodes[child_id][0] == op:
+                children.update(self._nodes[child_id][1])
+            else:
+                children.add(child_id)
+        if len(children) == 1:
+            return children.pop()
+        return self._node((op, tuple(sorted(children))))
+
+    def _term_id(self, text: str, prefix: bool) -> int:
+        pattern = normalize_text(text)
+        pattern_id = self._pattern_id(pattern)
+        terms = self._pattern_prefix_terms if prefix else self._pattern_word_terms
+        if terms[pattern_id] < 0:
+            terms[pattern_id] = self._term_count
+            self._term_count += 1
+            node = 0
+            for char in pattern:
+                node = self._goto[node][char]
+            self._term_nodes.add(node)
+        return terms[pattern_id]
+
+    def _build_roots(self) -> None:
+        for root in self._root_users:
+            if self._evaluate(root, set(), {}):
+                self._always_roots.add(root)
+                continue
+            # Ложный без найденных фраз запрос может стать истинным,
+            # только если в тексте есть хотя бы одна из его фраз
+            stack = [root]
+            seen = set()
+            while stack:
+                node_id = stack.pop()
+                if node_id in seen:
+                    continue
+                seen.add(node_id)
+                kind, args = self._nodes[node_id]
+                if kind == TERM:
+                    self._term_roots.setdefault(args, set()).add(root)
+                elif kind == NOT:
+                    stack.append(args)
+                else:
+                    stack.extend(args)
+
+    def _evaluate(self, node_id: int, terms: Set[int], memo: Dict[int, bool]) -> bool:
+        value = memo.get(node_id)
+        if value is None:
+            kind, args = self._nodes[node_id]
+            if kind == TERM:
+                value = args in terms
+            elif kind == NOT:
+                value = not self._evaluate(args, terms, memo)
+            elif kind == AND:
+                value = all(self._evaluate(child, terms, memo) for child in args)
+            else:
+                value = any(self._evaluate(child, terms, memo) for child in args)
+            memo[node_id] = value
+        return value
+
+    @property
+    def pattern_count(self) -> int:
+        return len(self._pattern_users)
+
+    @property
+    def plan_size(self) -> int:
+        """Число различных узлов в плане запросов"""
+        return len(self._nodes)
+
+    def _found_terms(self, text: str, hits: List[Tuple[int, int]]) -> Set[int]:
+        """Фразы запросов, совпавшие с границами слов"""
+        terms: Set[int] = set()
+        length = len(text)
+        for end, node in hits:
+            for pattern_id in self._out[node]:
+                word_term = self._pattern_word_terms[pattern_id]
+                prefix_term = self._pattern_prefix_terms[pattern_id]
+                if word_term < 0 and prefix_term < 0:
+                    continue
+                start = end - self._pattern_lengths[pattern_id] + 1
+                if start > 0 and is_word_char(text[start - 1]):
+                    continue
+                if prefix_term >= 0:
+                    terms.add(prefix_term)
+                if word_term >= 0 and (end + 1 == length or not is_word_char(text[end + 1])):
+                    terms.add(word_term)
+        return terms
+
+    def match(self, text: str) -> Set[int]:
+        """Пользователи, чьи ключевые слова встречаются в тексте"""
+        matched = set(self._always)
+        text = normalize_text(text) if text else ''
+        # В сообщении без текста (например, фото без подписи) проверять нечего:
+        # запросы из одних NOT, вроде NOT "spam", на нем не срабатывают
+        if not text or not self._pattern_users:
+            return matched
+
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        term_nodes = self._term_nodes
+        found: Set[int] = set()
+        hits: List[Tuple[int, int]] = []
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+                if node in term_nodes:
+                    hits.append((end, node))
+
+        for pattern_id in found:
+            matched |= self._pattern_users[pattern_id]
+
+        if not self._root_users:
+            return matched
+        terms = self._found_terms(text, hits) if hits else set()
+        roots = set(self._always_roots)
+        for term_id in terms:
+            roots |= self._term_roots.get(term_id, set())
+        # Общая память на сообщение: подвыражение вычисляется один раз для всех
+        memo: Dict[int, bool] = {}
+        for root in roots:
+            if self._evaluate(root, terms, memo):
+                matched |= self._root_users[root]
+        return matched
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Hashable, List, Optional, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+class MediaFanoutCache:
+    """Кэш file_id, полученных от Bot API при первой отправке медиа.
+
+    Первая доставка сообщения скачивает и загружает файлы один раз,
+    последующие подписчики получают те же фото по file_id.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, List[str]]]" = OrderedDict()
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+
+    def get(self, key: Hashable) -> Optional[List[str]]:
+        """Получение file_id по ключу сообщения"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, file_ids = entry
+        if time.monotonic() - stored_at > self.ttl:
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return file_ids
+
+    def put(self, key: Hashable, file_ids: List[str]) -> None:
+        """Сохранение file_id после успешной отправки"""
+        if not file_ids:
+            return
+        self._entries[key] = (time.monotonic(), list(file_ids))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._evict(oldest)
+
+    def lock(self, key: Hashable) -> asyncio.Lock:
+        """Блокировка, чтобы параллельные доставки не скачивали файл повторно"""
+        lock = self._locks.get(key)
+        if lock is None:
+            if len(self._locks) > self.max_entries * 2:
+                self._prune_locks()
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def _prune_locks(self) -> None:
+        """Удаление свободных блокировок сообщений, которых нет в кэше"""
+        for key in list(self._locks):
+            if key not in self._entries and not self._locks[key].locked():
+                del self._locks[key]
+
+    def _evict(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+        lock = self._locks.get(key)
+        if lock is not None and not lock.locked():
+            del self._locks[key]
+
+def media_cache_key(message) -> Tuple[int, str, int]:
+    """Ключ кэша: альбом целиком или отдельное сообщение"""
+    if getattr(message, 'grouped_id', None):
+        return (message.chat_id, 'album', message.grouped_id)
+    return (message.chat_id, 'message', message.id)
+
+def photo_file_id(sent_message) -> Optional[str]:
+    """file_id самого крупного размера фото из ответа Bot API"""
+    if sent_message is None or not getattr(sent_message, 'photo', None):
+        return None
+    return sent_message.photo[-1].file_id
+
+class MediaBuffer:
+    """Скачанный файл: байты в памяти или уникальный временный файл на диске"""
+
+    def __init__(self, data: Optional[bytes] = None, path: Optional[str] = None):
+        self.data = data
+        self.path = path
+        self._file: Optional[BinaryIO] = None
+
+    def input_file(self) -> Union[bytes, BinaryIO]:
+        """Содержимое для InputMediaPhoto/send_photo без лишних копий"""
+        if self.data is not None:
+            return self.data
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        return self._file
+
+    def close(self) -> None:
+        """Освобождение памяти и удаление временного файла"""
+        self.data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+async def download_media_buffer(message, memory_limit: int) -> Optional[MediaBuffer]:
+    """Скачивание медиа в память, крупные файлы сбрасываются во временный файл"""
+    size = getattr(getattr(message, 'file', None), 'size', None)
+    if size is not None and size > memory_limit:
+        ext = getattr(message.file, 'ext', None) or '.jpg'
+        fd, path = tempfile.mkstemp(prefix='tw_media_', suffix=ext)
+        os.close(fd)
+        try:
+            result = await message.download_media(file=path)
+        except Exception:
+            os.remove(path)
+            raise
+        if result is None:
+            os.remove(path)
+            return None
+        return MediaBuffer(path=path)
+
+    data = await message.download_media(file=bytes)
+    if data is None:
+        return None
+    return MediaBuffer(data=data)
+
+async def spool_media(message, directory: str) -> Optional[str]:
+    """Скачивание медиа в файл каталога directory для отдельного процесса доставки.
+
+    Файл удаляется вместе с записью журнала, когда все доставки завершены.
+    """
+    os.makedirs(directory, exist_ok=True)
+    ext = getattr(getattr(message, 'file', None), 'ext', None) or '.jpg'
+    fd, path = tempfile.mkstemp(prefix=f'{abs(message.chat_id)}_{message.id}_', suffix=ext, dir=directory)
+    os.close(fd)
+    try:
+        result = await message.download_media(file=path)
+    except Exception:
+        os.remove(path)
+        raise
+    if result is None:
+        os.remove(path)
+        return None
+    return path
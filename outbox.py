@@ -0,0 +1,352 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Outbox:
+    """Журнал доставок в SQLite для доставки не менее одного раза.
+
+    Каждая пара (сообщение, подписчик) записывается до отправки и
+    отмечается выполненной только после ответа Bot API. Незавершенные
+    доставки повторяются с экспоненциальной задержкой и после перезапуска.
+    """
+
+    PENDING = 'pending'
+    RETRY = 'retry'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            grouped_id INTEGER,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_error TEXT,
+            UNIQUE (chat_id, message_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, next_attempt_at);
+        -- Готовое к отправке содержимое сообщения для отдельных процессов доставки
+        CREATE TABLE IF NOT EXISTS payloads (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            media TEXT NOT NULL DEFAULT '[]',
+            file_ids TEXT,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        );
+    """
+
+    def __init__(
+        self,
+        filename: str = 'outbox.db',
+        max_attempts: int = 8,
+        base_delay: float = 5,
+        max_delay: float = 900,
+        ack_batch_size: int = 100,
+        ack_interval: float = 1.0,
+    ):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval = ack_interval
+        # Журнал может быть общим для приема и процессов доставки
+        self.conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # Подтверждения копятся и записываются пачкой
+        self._acks: List[int] = []
+        self._ack_requested = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _execute(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def _insert(self, rows: List[tuple]) -> Dict[int, int]:
+        job_ids = {}
+        with self._conn_lock, self.conn:
+            for row in rows:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO jobs (chat_id, message_id, grouped_id, user_id, status, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    row
+                )
+                # Уже записанная доставка не создает повторное задание
+                if cursor.rowcount:
+                    job_ids[row[3]] = cursor.lastrowid
+        return job_ids
+
+    async def add(
+        self,
+        chat_id: int,
+        message_id: int,
+        user_ids: Iterable[int],
+        grouped_id: Optional[int] = None,
+    ) -> Dict[int, int]:
+        """Запись доставок одного сообщения всем подписчикам одной транзакцией.
+
+        Возвращает user_id -> id задания только для новых доставок.
+        """
+        now = time.time()
+        rows = [
+            (chat_id, message_id, grouped_id, user_id, self.PENDING, now)
+            for user_id in user_ids
+        ]
+        if not rows:
+            return {}
+        return await self._execute(self._insert, rows)
+
+    def ack(self, job_id: int) -> None:
+        """Отметка об успешной доставке, записывается пачкой"""
+        self._acks.append(job_id)
+        if len(self._acks) >= self.ack_batch_size:
+            self._ack_requested.set()
+
+    def _write_acks(self, job_ids: List[int]) -> None:
+        with self._conn_lock, self.conn:
+            self.conn.executemany(
+                "UPDATE jobs SET status = ?, last_error = NULL WHERE id = ?",
+                [(self.DONE, job_id) for job_id in job_ids]
+            )
+
+    async def flush_acks(self) -> None:
+        if not self._acks:
+            return
+        job_ids, self._acks = self._acks, []
+        try:
+            await self._execute(self._write_acks, job_ids)
+        except Exception as e:
+            self._acks.extend(job_ids)
+            logger.error(f"Ошибка записи подтверждений доставки: {e}")
+
+    def _retry_delay(self, attempts: int) -> float:
+        """Экспоненциальная задержка со случайным разбросом"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    def _write_failure(self, job_id: int, error: str, permanent: bool) -> None:
+        with self._conn_lock, self.conn:
+            row = self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            attempts = row[0] + 1
+            if permanent or attempts >= self.max_attempts:
+                status, next_attempt_at = self.FAILED, 0
+            else:
+                status, next_attempt_at = self.RETRY, time.time() + self._retry_delay(attempts)
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, attempts, next_attempt_at, error[:500], job_id)
+            )
+        if status == self.FAILED:
+            logger.error(f"Доставка {job_id} отменена после {attempts} попыток: {error}")
+
+    async def fail(self, job_id: int, error: str, permanent: bool = False) -> None:
+        """Планирование повторной доставки или отказ от нее"""
+        await self._execute(self._write_failure, job_id, error, permanent)
+
+    @staticmethod
+    def _shard_filter(shard: Optional[Tuple[int, int]]) -> Tuple[str, tuple]:
+        """Условие на задания одного процесса доставки: (номер, всего)"""
+        if shard is None:
+            return "", ()
+        index, count = shard
+        return " AND abs(user_id) % ? = ?", (count, index)
+
+    def _claim(
+        self,
+        statuses: Tuple[str, ...],
+        due_before: float,
+        limit: int,
+        shard: Optional[Tuple[int, int]] = None,
+    ) -> List[tuple]:
+        shard_sql, shard_args = self._shard_filter(shard)
+        with self._conn_lock, self.conn:
+            placeholders = ", ".join("?" for _ in statuses)
+            rows = self.conn.execute(
+                f"SELECT id, chat_id, message_id, grouped_id, user_id FROM jobs "
+                f"WHERE status IN ({placeholders}) AND next_attempt_at <= ?{shard_sql} "
+                f"ORDER BY id LIMIT ?",
+                (*statuses, due_before, *shard_args, limit)
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE jobs SET status = ? WHERE id = ?",
+                [(self.PENDING, row[0]) for row in rows]
+            )
+        return rows
+
+    async def claim_due(self, limit: int = 500, shard: Optional[Tuple[int, int]] = None) -> List[tuple]:
+        """Задания, время повтора которых наступило"""
+        return await self._execute(self._claim, (self.RETRY,), time.time(), limit, shard)
+
+    def _select_unfinished(
+        self,
+        after_id: int,
+        until_id: Optional[int],
+        limit: int,
+        shard: Optional[Tuple[int, int]],
+    ) -> List[tuple]:
+        shard_sql, shard_args = self._shard_filter(shard)
+        if until_id is not None:
+            shard_sql = " AND id <= ?" + shard_sql
+            shard_args = (until_id, *shard_args)
+        with self._conn_lock, self.conn:
+            rows = self.conn.execute(
+                f"SELECT id, chat_id, message_id, grouped_id, user_id, status FROM jobs "
+                f"WHERE status IN (?, ?) AND id > ?{shard_sql} ORDER BY id LIMIT ?",
+                (self.PENDING, self.RETRY, after_id, *shard_args, limit)
+            ).fetchall()
+            # Повторы забираются в той же транзакции, иначе claim_due поставит их еще раз
+            self.conn.executemany(
+                "UPDATE jobs SET status = ? WHERE id = ?",
+                [(self.PENDING, row[0]) for row in rows if row[5] == self.RETRY]
+            )
+        return [row[:5] for row in rows]
+
+    async def unfinished(
+        self,
+        after_id: int = 0,
+        limit: int = 500,
+        shard: Optional[Tuple[int, int]] = None,
+        until_id: Optional[int] = None,
+    ) -> List[tuple]:
+        """Незавершенные задания по порядку, для повтора после перезапуска.
+
+        Задания, ждавшие повтора, забираются: переводятся в pending.
+        until_id ограничивает повтор заданиями, записанными до запуска приема.
+        Процесс доставки читает так же новые задания своей доли пользователей.
+        """
+        return await self._execute(self._select_unfinished, after_id, until_id, limit, shard)
+
+    def _select_last_id(self) -> int:
+        with self._conn_lock:
+            row = self.conn.execute("SELECT MAX(id) FROM jobs").fetchone()
+        return row[0] or 0
+
+    async def last_id(self) -> int:
+        """id последнего записанного задания, 0 для пустого журнала"""
+        return await self._execute(self._select_last_id)
+
+    def _insert_payload(self, row: tuple) -> bool:
+        with self._conn_lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO payloads (chat_id, message_id, text, media, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                row
+            )
+            return bool(cursor.rowcount)
+
+    async def add_payload(self, chat_id: int, message_id: int, text: str, media: List[str]) -> bool:
+        """Сохранение текста и путей к скачанным файлам сообщения.
+
+        Возвращает False, если содержимое этого сообщения уже записано.
+        """
+        row = (chat_id, message_id, text, json.dumps(media), time.time())
+        return await self._execute(self._insert_payload, row)
+
+    def _select_payloads(self, keys: List[Tuple[int, int]]) -> Dict[Tuple[int, int], tuple]:
+        payloads = {}
+        with self._conn_lock:
+            for chat_id, message_id in keys:
+                row = self.conn.execute(
+                    "SELECT text, media, file_ids FROM payloads WHERE chat_id = ? AND message_id = ?",
+                    (chat_id, message_id)
+                ).fetchone()
+                if row is not None:
+                    text, media, file_ids = row
+                    payloads[(chat_id, message_id)] = (text, json.loads(media), json.loads(file_ids or '[]'))
+        return payloads
+
+    async def get_payloads(self, keys: Iterable[Tuple[int, int]]) -> Dict[Tuple[int, int], tuple]:
+        """(chat_id, message_id) -> (текст, пути к файлам, file_id уже загруженных фото)"""
+        return await self._execute(self._select_payloads, list(keys))
+
+    def _update_file_ids(self, chat_id: int, message_id: int, file_ids: str) -> None:
+        with self._conn_lock, self.conn:
+            self.conn.execute(
+                "UPDATE payloads SET file_ids = ? WHERE chat_id = ? AND message_id = ?",
+                (file_ids, chat_id, message_id)
+            )
+
+    async def set_file_ids(self, chat_id: int, message_id: int, file_ids: List[str]) -> None:
+        """file_id после первой загрузки, чтобы другие процессы не загружали файлы снова"""
+        await self._execute(self._update_file_ids, chat_id, message_id, json.dumps(file_ids))
+
+    def _purge(self, older_than: float) -> int:
+        with self._conn_lock, self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND created_at < ?",
+                (self.DONE, self.FAILED, older_than)
+            )
+            removed = cursor.rowcount
+            # Содержимое сообщения нужно, пока по нему остались задания
+            stale = self.conn.execute(
+                "SELECT chat_id, message_id, media FROM payloads p WHERE created_at < ? AND NOT EXISTS ("
+                "SELECT 1 FROM jobs j WHERE j.chat_id = p.chat_id AND j.message_id = p.message_id)",
+                (older_than,)
+            ).fetchall()
+            self.conn.executemany(
+                "DELETE FROM payloads WHERE chat_id = ? AND message_id = ?",
+                [(chat_id, message_id) for chat_id, message_id, _ in stale]
+            )
+        for _, _, media in stale:
+            for path in json.loads(media):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return removed
+
+    async def purge(self, max_age: float = 86400) -> int:
+        """Удаление старых завершенных заданий"""
+        return await self._execute(self._purge, time.time() - max_age)
+
+    async def _run(self) -> None:
+        last_purge = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._ack_requested.wait(), timeout=self.ack_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._ack_requested.clear()
+            await self.flush_acks()
+            if time.monotonic() - last_purge > 3600:
+                last_purge = time.monotonic()
+                try:
+                    removed = await self.purge()
+                    logger.info(f"Удалено завершенных доставок из журнала: {removed}")
+                except Exception as e:
+                    logger.error(f"Ошибка очистки журнала доставок: {e}")
+
+    def start(self) -> None:
+        """Запуск фоновой записи подтверждений"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox-acks")
+
+    async def close(self) -> None:
+        """Запись оставшихся подтверждений и закрытие базы"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush_acks()
+        with self._conn_lock:
+            self.conn.close()
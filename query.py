@@ -0,0 +1,149 @@
+import re
+from functools import lru_cache
+from typing import List, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Операторы можно писать по-английски или по-русски, в любом регистре
+OPERATORS = {
+    'AND': 'and', 'И': 'and',
+    'OR': 'or', 'ИЛИ': 'or',
+    'NOT': 'not', 'НЕ': 'not',
+}
+# Ограничение на размер одного запроса
+MAX_QUERY_TERMS = 50
+
+_TOKEN_RE = re.compile(r'\s*(?:"([^"]*)"|([()])|([^\s()"]+))')
+_OPERATOR_RE = re.compile(r'(?<!\w)(?:AND|OR|NOT|И|ИЛИ|НЕ)(?!\w)|[()]', re.IGNORECASE)
+
+class QuerySyntaxError(ValueError):
+    """Ошибка в запросе ключевых слов; текст показывается пользователю"""
+
+def is_query(text: str) -> bool:
+    """Есть ли вне кавычек операторы или скобки.
+
+    Список фраз в кавычках без операторов остается списком ключевых слов,
+    любая из которых дает совпадение.
+    """
+    return bool(_OPERATOR_RE.search(re.sub(r'"[^"]*"', ' ', text)))
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN_RE.match(text, position)
+        if match is None:
+            raise QuerySyntaxError("Незакрытая кавычка")
+        phrase, bracket, word = match.groups()
+        if phrase is not None:
+            phrase = ' '.join(phrase.split())
+            if not phrase.rstrip('*').strip():
+                raise QuerySyntaxError("Пустое ключевое слово в кавычках")
+            tokens.append(('term', phrase))
+        elif bracket is not None:
+            tokens.append((bracket, bracket))
+        else:
+            operator = OPERATORS.get(word.upper())
+            if operator is None:
+                raise QuerySyntaxError(f"Непонятное слово {word}: ключевые слова указываются в кавычках")
+            tokens.append((operator, word))
+        position = match.end()
+    return tokens
+
+class _Parser:
+    """Разбор с приоритетами NOT > AND > OR.
+
+    Фразы, идущие подряд без оператора, объединяются через OR, как в
+    прежнем списке ключевых слов. "a" NOT "b" означает "a" AND NOT "b".
+    """
+
+    def __init__(self, tokens: List[Tuple[str, str]]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> str:
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else ''
+
+    def take(self, kind: str) -> None:
+        if self.peek() != kind:
+            raise QuerySyntaxError("Ожидалась закрывающая скобка" if kind == ')' else "Ошибка в запросе")
+        self.position += 1
+
+    def parse_or(self) -> tuple:
+        children = [self.parse_and()]
+        while self.peek() in ('or', 'term', '('):
+            if self.peek() == 'or':
+                self.position += 1
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else ('or', tuple(children))
+
+    def parse_and(self) -> tuple:
+        children = [self.parse_unary()]
+        while self.peek() in ('and', 'not'):
+            if self.peek() == 'and':
+                self.position += 1
+                children.append(self.parse_unary())
+            else:
+                # Оператор NOT между выражениями работает как AND NOT
+                self.position += 1
+                children.append(('not', self.parse_unary()))
+        return children[0] if len(children) == 1 else ('and', tuple(children))
+
+    def parse_unary(self) -> tuple:
+        kind = self.peek()
+        if kind == 'not':
+            self.position += 1
+            return ('not', self.parse_unary())
+        if kind == '(':
+            self.position += 1
+            node = self.parse_or()
+            self.take(')')
+            return node
+        if kind == 'term':
+            text = self.tokens[self.position][1]
+            self.position += 1
+            # Звездочка в конце - поиск по началу слова
+            if text.endswith('*'):
+                return ('term', text.rstrip('*').strip(), True)
+            return ('term', text, False)
+        if not kind:
+            raise QuerySyntaxError("Запрос обрывается: не хватает ключевого слова")
+        raise QuerySyntaxError(f"Неожиданное {self.tokens[self.position][1]}")
+
+def _count_terms(node: tuple) -> int:
+    if node[0] == 'term':
+        return 1
+    if node[0] == 'not':
+        return _count_terms(node[1])
+    return sum(_count_terms(child) for child in node[1])
+
+@lru_cache(maxsize=4096)
+def parse_query(text: str) -> tuple:
+    """Разбор запроса в дерево из кортежей:
+    ('term', фраза, по_началу_слова), ('and', дети), ('or', дети), ('not', ребенок)
+    """
+    tokens = _tokenize(text)
+    if not tokens:
+        raise QuerySyntaxError("Пустой запрос")
+    parser = _Parser(tokens)
+    node = parser.parse_or()
+    if parser.position != len(tokens):
+        raise QuerySyntaxError(f"Неожиданное {tokens[parser.position][1]}")
+    if _count_terms(node) > MAX_QUERY_TERMS:
+        raise QuerySyntaxError(f"Слишком длинный запрос: не больше {MAX_QUERY_TERMS} ключевых слов")
+    return node
+
+def format_query(node: tuple, parent: str = '') -> str:
+    """Запись дерева запроса в каноническом виде"""
+    kind = node[0]
+    if kind == 'term':
+        return f'"{node[1]}*"' if node[2] else f'"{node[1]}"'
+    if kind == 'not':
+        return f"NOT {format_query(node[1], 'not')}"
+    text = f" {kind.upper()} ".join(format_query(child, kind) for child in node[1])
+    # Скобки нужны, когда выражение слабее внешнего оператора
+    if parent == 'not' or (parent == 'and' and kind == 'or'):
+        return f"({text})"
+    return text
@@ -1,14 +1,177 @@
+import asyncio
 import json
 import os
-from typing import Dict, Set
+import sqlite3
+import tempfile
+import threading
+from array import array
+from typing import Callable, Dict, FrozenSet, Hashable, Iterable, List, Optional, Set, Union
 import logging
+from matcher import KeywordMatcher
+from metrics import STAGE_SECONDS
 
 logger = logging.getLogger(__name__)
 
+# Числовой peer ID канала; строка @username остается только у старых
+# настроек, которые еще не переведены на ID
+ChannelKey = Union[int, str]
+
+class InternTable:
+    """Общая таблица значений и их номеров.
+
+    Популярные каналы и ключевые слова хранятся в одном экземпляре, а
+    настройки пользователей ссылаются на них номерами. Таблица только
+    растет до перезапуска, удаленные значения остаются в ней.
+    """
+
+    def __init__(self):
+        self._ids: Dict[Hashable, int] = {}
+        self._values: List[Hashable] = []
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def id(self, value: Hashable) -> int:
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = len(self._values)
+            self._ids[value] = value_id
+            self._values.append(value)
+        return value_id
+
+    def ids(self, values: Iterable[Hashable]) -> array:
+        """Массив номеров без повторов"""
+        if not isinstance(values, (list, tuple, set, frozenset)):
+            values = list(values)
+        # Уже известные значения ищутся без вызова метода на каждое
+        ids = set(map(self._ids.get, values))
+        if None in ids:
+            ids.discard(None)
+            ids.update(self.id(value) for value in values if value not in self._ids)
+        return array('I', ids)
+
+    def value(self, value_id: int) -> Hashable:
+        return self._values[value_id]
+
+    def values(self, ids: Iterable[int]) -> FrozenSet:
+        values = self._values
+        return frozenset(values[value_id] for value_id in ids)
+
+# Каналы (ID или @username) и ключевые слова всех пользователей
+CHANNELS = InternTable()
+KEYWORDS = InternTable()
+
+class UserSettings:
+    """Настройки одного пользователя в компактном виде.
+
+    Каналы и ключевые слова хранятся массивами номеров из общих таблиц
+    CHANNELS и KEYWORDS. Доступ остается словарным: settings['channels']
+    возвращает frozenset, поэтому изменение на месте вроде
+    settings['keywords'].add(...) падает, а не теряется молча. Изменение
+    сохраняется присваиванием settings['channels'] = ...
+    """
+
+    __slots__ = ('channel_ids', 'keyword_ids', 'active', 'digest')
+
+    FIELDS = ('channels', 'keywords', 'active', 'digest')
+
+    def __init__(
+        self,
+        channels: Iterable[ChannelKey] = (),
+        keywords: Iterable[str] = (),
+        active: bool = False,
+        digest: bool = False,
+    ):
+        self.channel_ids = CHANNELS.ids(channels)
+        self.keyword_ids = KEYWORDS.ids(keywords)
+        self.active = bool(active)
+        self.digest = bool(digest)
+
+    @classmethod
+    def from_dict(cls, settings: Dict) -> 'UserSettings':
+        return cls(
+            settings.get('channels', ()),
+            settings.get('keywords', ()),
+            settings.get('active', False),
+            settings.get('digest', False)
+        )
+
+    def __getitem__(self, key: str):
+        if key == 'channels':
+            return CHANNELS.values(self.channel_ids)
+        if key == 'keywords':
+            return KEYWORDS.values(self.keyword_ids)
+        if key == 'active':
+            return self.active
+        if key == 'digest':
+            return self.digest
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value) -> None:
+        if key == 'channels':
+            self.channel_ids = CHANNELS.ids(value)
+        elif key == 'keywords':
+            self.keyword_ids = KEYWORDS.ids(value)
+        elif key == 'active':
+            self.active = bool(value)
+        elif key == 'digest':
+            self.digest = bool(value)
+        else:
+            raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.FIELDS
+
+    def keys(self):
+        return iter(self.FIELDS)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, UserSettings):
+            other = dict(other)
+        return dict(self) == other
+
+    def __repr__(self) -> str:
+        return f"UserSettings({dict(self)!r})"
+
 class UserSettingsStorage:
-    def __init__(self, filename: str = 'user_settings.json'):
+    def __init__(
+        self,
+        filename: str = 'user_settings.json',
+        write_behind: bool = False,
+        flush_interval: float = 2.0,
+        flush_threshold: int = 100,
+    ):
         self.filename = filename
-        self.settings: Dict[int, Dict] = {}
+        self.settings: Dict[int, UserSettings] = {}
+        # Сведения о каналах: peer ID -> username и название
+        self.channel_info: Dict[int, Dict] = {}
+        # Отложенная запись: изменения копятся и сбрасываются фоновой задачей
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._dirty: Set[int] = set()
+        self._dirty_channels: Set[int] = set()
+        self._flush_requested = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+        # Обратный индекс: канал -> активные подписчики
+        self.channel_subscribers: Dict[ChannelKey, Set[int]] = {}
+        # Номера каналов, под которыми пользователь сейчас записан в индексе
+        self._indexed_channels: Dict[int, array] = {}
+        # Скомпилированные матчеры ключевых слов, строятся лениво по каналу
+        self._matchers: Dict[ChannelKey, KeywordMatcher] = {}
+        # Подписчики на изменение множества отслеживаемых каналов
+        self._channels_listeners: List[Callable[[Set[ChannelKey], Set[ChannelKey]], None]] = []
         self.load_settings()
     
     def load_settings(self) -> None:
@@ -17,19 +180,22 @@ class UserSettingsStorage:
             if os.path.exists(self.filename):
                 with open(self.filename, 'r', encoding='utf-8') as f:
                     data = json.load(f)
+                    # Старый формат файла содержал только пользователей
+                    if 'users' in data:
+                        self.channel_info = {
+                            int(channel_id): info
+                            for channel_id, info in data.get('channels', {}).items()
+                        }
+                        data = data['users']
                     # Конвертируем строковые ключи обратно в int
                     self.settings = {
-                        int(user_id): {
-                            'channels': set(channels),
-                            'keywords': set(keywords),
-                            'active': active
-                        }
-                        for user_id, settings in data.items()
-                        for channels, keywords, active in [(
+                        int(user_id): UserSettings(
                             settings['channels'],
                             settings['keywords'],
-                            settings['active']
-                        )]
+                            settings['active'],
+                            settings.get('digest', False)
+                        )
+                        for user_id, settings in data.items()
                     }
                 logger.info(f"Загружены настройки для {len(self.settings)} пользователей")
             else:
@@ -38,41 +204,432 @@ class UserSettingsStorage:
         except Exception as e:
             logger.error(f"Ошибка при загрузке настроек: {e}")
             self.settings = {}
+        self._rebuild_index()
+
+    def _rebuild_index(self) -> None:
+        """Полное перестроение индекса канал -> подписчики"""
+        old_channels = set(self.channel_subscribers)
+        subscribers: Dict[int, Set[int]] = {}
+        self._indexed_channels = {}
+        self._matchers = {}
+        # Индекс строится по номерам каналов, значения подставляются один раз в конце
+        for user_id, settings in self.settings.items():
+            if not settings.active or not settings.channel_ids:
+                continue
+            self._indexed_channels[user_id] = settings.channel_ids
+            for channel_id in settings.channel_ids:
+                users = subscribers.get(channel_id)
+                if users is None:
+                    users = subscribers[channel_id] = set()
+                users.add(user_id)
+        self.channel_subscribers = {
+            CHANNELS.value(channel_id): users for channel_id, users in subscribers.items()
+        }
+        new_channels = set(self.channel_subscribers)
+        if old_channels != new_channels:
+            for listener in self._channels_listeners:
+                listener(new_channels - old_channels, old_channels - new_channels)
+
+    def _reindex_user(self, user_id: int) -> None:
+        """Инкрементальное обновление индекса для одного пользователя"""
+        # Настройки могли быть изменены на месте, поэтому сравниваем
+        # с тем, что было проиндексировано ранее, а не со старой записью
+        old_ids = self._indexed_channels.pop(user_id, None)
+        old_channels = CHANNELS.values(old_ids) if old_ids else set()
+        settings = self.settings.get(user_id)
+        new_ids = settings.channel_ids if settings is not None and settings.active else None
+        new_channels = CHANNELS.values(new_ids) if new_ids else set()
+
+        added: Set[ChannelKey] = set()
+        removed: Set[ChannelKey] = set()
+        for channel in old_channels - new_channels:
+            subscribers = self.channel_subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(user_id)
+                if not subscribers:
+                    del self.channel_subscribers[channel]
+                    removed.add(channel)
+        for channel in new_channels - old_channels:
+            if channel not in self.channel_subscribers:
+                self.channel_subscribers[channel] = set()
+                added.add(channel)
+            self.channel_subscribers[channel].add(user_id)
+
+        if new_ids:
+            # Массив номеров не меняется на месте, его можно хранить без копии
+            self._indexed_channels[user_id] = new_ids
+
+        # Ключевые слова могли поменяться, сбрасываем матчеры всех затронутых каналов
+        for channel in old_channels | new_channels:
+            self._matchers.pop(channel, None)
+
+        if added or removed:
+            for listener in self._channels_listeners:
+                listener(added, removed)
+
+    def add_channels_listener(self, listener: Callable[[Set[ChannelKey], Set[ChannelKey]], None]) -> None:
+        """Подписка на появление и исчезновение отслеживаемых каналов"""
+        self._channels_listeners.append(listener)
     
-    def save_settings(self) -> None:
-        """Сохранение настроек в файл"""
-        try:
-            # Конвертируем множества в списки для JSON
-            data = {
+    def _snapshot(self, user_ids: Iterable[int], channel_ids: Iterable[int] = ()) -> Dict:
+        """Копия данных для записи, не зависящая от дальнейших изменений"""
+        # JSON-файл можно только перезаписать целиком, поэтому берем всех
+        return {
+            'users': {
                 str(user_id): {
                     'channels': list(settings['channels']),
                     'keywords': list(settings['keywords']),
-                    'active': settings['active']
+                    'active': settings['active'],
+                    'digest': settings.get('digest', False)
                 }
                 for user_id, settings in self.settings.items()
+            },
+            'channels': {
+                str(channel_id): dict(info)
+                for channel_id, info in self.channel_info.items()
             }
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+        }
+
+    def _write_snapshot(self, data: Dict) -> None:
+        """Атомарная запись: временный файл и переименование поверх старого"""
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp_path = tempfile.mkstemp(prefix='.settings_', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.filename)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def save_settings(self) -> None:
+        """Сохранение настроек всех пользователей"""
+        try:
+            self._write_snapshot(self._snapshot(list(self.settings), list(self.channel_info)))
+            self._dirty.clear()
+            self._dirty_channels.clear()
             logger.info(f"Сохранены настройки для {len(self.settings)} пользователей")
         except Exception as e:
             logger.error(f"Ошибка при сохранении настроек: {e}")
     
-    def get_user_settings(self, user_id: int) -> Dict:
+    def get_user_settings(self, user_id: int) -> UserSettings:
         """Получение настроек пользователя"""
         if user_id not in self.settings:
-            self.settings[user_id] = {
-                'channels': set(),
-                'keywords': set(),
-                'active': False
-            }
-            self.save_settings()
+            # Пустые настройки не сохраняем: они равносильны отсутствию записи
+            self.settings[user_id] = UserSettings()
         return self.settings[user_id]
     
-    def update_user_settings(self, user_id: int, settings: Dict) -> None:
+    def update_user_settings(self, user_id: int, settings: Union[UserSettings, Dict]) -> None:
         """Обновление настроек пользователя"""
+        if not isinstance(settings, UserSettings):
+            settings = UserSettings.from_dict(settings)
         self.settings[user_id] = settings
-        self.save_settings()
+        self._reindex_user(user_id)
+        self.save_user_settings(user_id)
+
+    def save_user_settings(self, user_id: int) -> None:
+        """Сохранение изменений одного пользователя"""
+        self._persist(user_ids=(user_id,))
+
+    def set_channel_info(self, channel_id: int, username: Optional[str], title: str) -> None:
+        """Сохранение username и названия канала по его peer ID"""
+        info = {'username': username, 'title': title}
+        if self.channel_info.get(channel_id) == info:
+            return
+        self.channel_info[channel_id] = info
+        self._persist(channel_ids=(channel_id,))
+
+    def get_channel_info(self, channel_id: ChannelKey) -> Optional[Dict]:
+        """username и название канала, если канал уже разрешен в ID"""
+        return self.channel_info.get(channel_id)
+
+    def _persist(self, user_ids: Iterable[int] = (), channel_ids: Iterable[int] = ()) -> None:
+        if self.write_behind:
+            self._dirty.update(user_ids)
+            self._dirty_channels.update(channel_ids)
+            if len(self._dirty) + len(self._dirty_channels) >= self.flush_threshold:
+                self._flush_requested.set()
+            return
+        try:
+            self._write_snapshot(self._snapshot(user_ids, channel_ids))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении настроек: {e}")
+
+    async def flush(self) -> None:
+        """Запись накопленных изменений в потоке executor"""
+        async with self._flush_lock:
+            if not self._dirty and not self._dirty_channels:
+                return
+            dirty, self._dirty = self._dirty, set()
+            dirty_channels, self._dirty_channels = self._dirty_channels, set()
+            # Снимок делается в потоке event loop, запись на диск - в executor
+            snapshot = self._snapshot(dirty, dirty_channels)
+            loop = asyncio.get_running_loop()
+            try:
+                with STAGE_SECONDS.time('storage_flush'):
+                    await loop.run_in_executor(None, self._write_snapshot, snapshot)
+                logger.debug(f"Сброшены изменения {len(dirty)} пользователей")
+            except Exception as e:
+                # Не теряем изменения: они попадут в следующий сброс
+                self._dirty |= dirty
+                self._dirty_channels |= dirty_channels
+                logger.error(f"Ошибка при сохранении настроек: {e}")
+
+    async def _run_flusher(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        """Запуск фонового сброса изменений в текущем event loop"""
+        if self.write_behind and self._flusher is None:
+            self._closing = False
+            self._flusher = asyncio.create_task(self._run_flusher(), name="settings-flusher")
+
+    async def close(self) -> None:
+        """Остановка фонового сброса и финальная запись изменений"""
+        if self._flusher is not None:
+            # Задача не отменяется: отмена во время записи в executor оставила бы
+            # поток писать старый снимок параллельно с финальным сбросом
+            self._closing = True
+            self._flush_requested.set()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
     
-    def get_all_settings(self) -> Dict[int, Dict]:
+    def get_all_settings(self) -> Dict[int, UserSettings]:
         """Получение настроек всех пользователей"""
-        return self.settings 
\ No newline at end of file
+        return self.settings
+
+    def get_watched_channels(self) -> Set[ChannelKey]:
+        """Каналы, которые отслеживает хотя бы один активный пользователь"""
+        return set(self.channel_subscribers)
+
+    def get_channel_subscribers(self, channel: ChannelKey) -> Set[int]:
+        """Получение активных подписчиков канала"""
+        return self.channel_subscribers.get(channel, set())
+
+    def get_channel_matcher(self, channel: ChannelKey) -> KeywordMatcher:
+        """Получение скомпилированного матчера ключевых слов канала"""
+        matcher = self._matchers.get(channel)
+        if matcher is None:
+            matcher = KeywordMatcher({
+                user_id: self.settings[user_id]['keywords']
+                for user_id in self.get_channel_subscribers(channel)
+            })
+            self._matchers[channel] = matcher
+        return matcher
+
+    def match_channel(self, channel: ChannelKey, text: str) -> Set[int]:
+        """Подписчики канала, чьи ключевые слова найдены в тексте"""
+        if channel not in self.channel_subscribers:
+            return set()
+        return self.get_channel_matcher(channel).match(text)
+
+class SqliteSettingsStorage(UserSettingsStorage):
+    """Хранилище настроек в SQLite (WAL) с нормализованными таблицами.
+
+    Изменение одного пользователя переписывает только его строки,
+    а не весь файл, как в JSON-хранилище.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            active INTEGER NOT NULL DEFAULT 0,
+            digest INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS channels (
+            channel_id INTEGER PRIMARY KEY,
+            username TEXT,
+            title TEXT
+        );
+        CREATE TABLE IF NOT EXISTS user_channel_ids (
+            user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, channel_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_user_channel_ids_channel ON user_channel_ids(channel_id);
+        -- @username каналов, еще не переведенных на числовые ID
+        CREATE TABLE IF NOT EXISTS user_channels (
+            user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            channel TEXT NOT NULL,
+            PRIMARY KEY (user_id, channel)
+        );
+        CREATE INDEX IF NOT EXISTS idx_user_channels_channel ON user_channels(channel);
+        CREATE TABLE IF NOT EXISTS user_keywords (
+            user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            keyword TEXT NOT NULL,
+            PRIMARY KEY (user_id, keyword)
+        );
+    """
+
+    def __init__(self, filename: str = 'user_settings.db', **kwargs):
+        # Соединение используется и из executor при отложенной записи
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(self.SCHEMA)
+        # Базы, созданные до режима дайджеста, получают новый столбец
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if 'digest' not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN digest INTEGER NOT NULL DEFAULT 0")
+            self.conn.commit()
+        super().__init__(filename, **kwargs)
+
+    def load_settings(self) -> None:
+        """Загрузка настроек из базы"""
+        try:
+            # Строки собираются в списки, записи пользователей строятся один раз
+            channels: Dict[int, List[ChannelKey]] = {}
+            for user_id, channel_id in self.conn.execute("SELECT user_id, channel_id FROM user_channel_ids"):
+                channels.setdefault(user_id, []).append(channel_id)
+            for user_id, channel in self.conn.execute("SELECT user_id, channel FROM user_channels"):
+                channels.setdefault(user_id, []).append(channel)
+            keywords: Dict[int, List[str]] = {}
+            for user_id, keyword in self.conn.execute("SELECT user_id, keyword FROM user_keywords"):
+                keywords.setdefault(user_id, []).append(keyword)
+            settings = {
+                user_id: UserSettings(channels.get(user_id, ()), keywords.get(user_id, ()), active, digest)
+                for user_id, active, digest in self.conn.execute("SELECT user_id, active, digest FROM users")
+            }
+            self.channel_info = {
+                channel_id: {'username': username, 'title': title}
+                for channel_id, username, title in self.conn.execute(
+                    "SELECT channel_id, username, title FROM channels"
+                )
+            }
+            self.settings = settings
+            logger.info(f"Загружены настройки для {len(self.settings)} пользователей")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке настроек: {e}")
+            self.settings = {}
+        self._rebuild_index()
+
+    def _snapshot(self, user_ids: Iterable[int], channel_ids: Iterable[int] = ()) -> Dict:
+        """Строки для записи только измененных пользователей и каналов"""
+        channels = [
+            (channel_id, self.channel_info[channel_id]['username'], self.channel_info[channel_id]['title'])
+            for channel_id in channel_ids
+            if channel_id in self.channel_info
+        ]
+        rows = []
+        for user_id in user_ids:
+            settings = self.settings.get(user_id)
+            if settings is None:
+                continue
+            rows.append((
+                user_id,
+                int(settings['active']),
+                int(settings.get('digest', False)),
+                list(settings['channels']),
+                list(settings['keywords'])
+            ))
+        return {'users': rows, 'channels': channels}
+
+    def _write_snapshot(self, snapshot: Dict) -> None:
+        """Запись пользователей и каналов в одной транзакции"""
+        with self._conn_lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO channels (channel_id, username, title) VALUES (?, ?, ?) "
+                "ON CONFLICT(channel_id) DO UPDATE SET username = excluded.username, title = excluded.title",
+                snapshot['channels']
+            )
+            for user_id, active, digest, channels, keywords in snapshot['users']:
+                self.conn.execute(
+                    "INSERT INTO users (user_id, active, digest) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET active = excluded.active, digest = excluded.digest",
+                    (user_id, active, digest)
+                )
+                self.conn.execute("DELETE FROM user_channel_ids WHERE user_id = ?", (user_id,))
+                self.conn.executemany(
+                    "INSERT INTO user_channel_ids (user_id, channel_id) VALUES (?, ?)",
+                    [(user_id, channel) for channel in channels if isinstance(channel, int)]
+                )
+                self.conn.execute("DELETE FROM user_channels WHERE user_id = ?", (user_id,))
+                self.conn.executemany(
+                    "INSERT INTO user_channels (user_id, channel) VALUES (?, ?)",
+                    [(user_id, channel) for channel in channels if isinstance(channel, str)]
+                )
+                self.conn.execute("DELETE FROM user_keywords WHERE user_id = ?", (user_id,))
+                self.conn.executemany(
+                    "INSERT INTO user_keywords (user_id, keyword) VALUES (?, ?)",
+                    [(user_id, keyword) for keyword in keywords]
+                )
+
+    def is_empty(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    async def close(self) -> None:
+        """Финальный сброс изменений и закрытие соединения"""
+        await super().close()
+        with self._conn_lock:
+            self.conn.close()
+
+def sqlite_has_users(db_filename: str) -> bool:
+    """Есть ли в базе пользователи, без загрузки настроек и индекса"""
+    if not os.path.exists(db_filename):
+        return False
+    conn = sqlite3.connect(db_filename)
+    try:
+        return conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError:
+        # Таблиц еще нет
+        return False
+    finally:
+        conn.close()
+
+def migrate_json_to_sqlite(json_filename: str, db_filename: str) -> int:
+    """Однократный перенос настроек из JSON-файла в SQLite.
+
+    Переносит данные, только если база еще пуста. Возвращает число
+    перенесенных пользователей.
+    """
+    if not os.path.exists(json_filename) or sqlite_has_users(db_filename):
+        return 0
+    target = SqliteSettingsStorage(db_filename)
+    try:
+        if not target.is_empty():
+            return 0
+        source = UserSettingsStorage(json_filename)
+        target.settings = source.get_all_settings()
+        target.channel_info = source.channel_info
+        target.save_settings()
+        logger.info(f"Настройки {len(target.settings)} пользователей перенесены из {json_filename} в {db_filename}")
+        return len(target.settings)
+    finally:
+        target.conn.close()
+
+def create_storage() -> UserSettingsStorage:
+    """Создание хранилища по переменным окружения SETTINGS_*"""
+    backend = os.environ.get('SETTINGS_BACKEND', 'sqlite')
+    options = {
+        'write_behind': os.environ.get('SETTINGS_WRITE_BEHIND', '1') == '1',
+        'flush_interval': float(os.environ.get('SETTINGS_FLUSH_INTERVAL', 2.0)),
+        'flush_threshold': int(os.environ.get('SETTINGS_FLUSH_THRESHOLD', 100)),
+    }
+    if backend == 'json':
+        return UserSettingsStorage(os.environ.get('SETTINGS_FILE', 'user_settings.json'), **options)
+    db_filename = os.environ.get('SETTINGS_FILE', 'user_settings.db')
+    migrate_json_to_sqlite(os.environ.get('SETTINGS_JSON_FILE', 'user_settings.json'), db_filename)
+    return SqliteSettingsStorage(db_filename, **options)
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Перенос настроек из JSON в SQLite")
+    parser.add_argument('json_file', nargs='?', default='user_settings.json')
+    parser.add_argument('db_file', nargs='?', default='user_settings.db')
+    args = parser.parse_args()
+    count = migrate_json_to_sqlite(args.json_file, args.db_file)
+    print(f"Перенесено пользователей: {count}")
\ No newline at end of file
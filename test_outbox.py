@@ -0,0 +1,68 @@
+"""Проверки повтора журнала доставок (outbox.py) после перезапуска.
+
+Запуск:
+    python -m unittest test_outbox
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+from outbox import Outbox
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'outbox.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_with_outbox(self, scenario):
+        async def run():
+            outbox = Outbox(self.filename)
+            try:
+                await scenario(outbox)
+            finally:
+                await outbox.close()
+        asyncio.run(run())
+
+    def test_replay_skips_jobs_added_during_replay(self):
+        async def scenario(outbox):
+            old = await outbox.add(-100, 1, [1, 2])
+            until_id = await outbox.last_id()
+            self.assertEqual(until_id, old[2])
+
+            page = await outbox.unfinished(after_id=0, limit=1, until_id=until_id)
+            self.assertEqual([row[0] for row in page], [old[1]])
+            # Новое сообщение пришло во время повтора и уже поставлено обработчиком
+            live = await outbox.add(-100, 2, [1])
+            page = await outbox.unfinished(after_id=page[-1][0], limit=1, until_id=until_id)
+            self.assertEqual([row[0] for row in page], [old[2]])
+            page = await outbox.unfinished(after_id=page[-1][0], limit=1, until_id=until_id)
+            self.assertEqual(page, [])
+
+            # Без границы задание читается, как в процессах доставки
+            page = await outbox.unfinished(after_id=until_id)
+            self.assertEqual([row[0] for row in page], [live[1]])
+        self.run_with_outbox(scenario)
+
+    def test_last_id_of_empty_outbox(self):
+        async def scenario(outbox):
+            self.assertEqual(await outbox.last_id(), 0)
+            self.assertEqual(await outbox.unfinished(until_id=0), [])
+        self.run_with_outbox(scenario)
+
+    def test_replay_claims_retry_rows(self):
+        async def scenario(outbox):
+            job_id = (await outbox.add(-100, 1, [1]))[1]
+            await outbox.fail(job_id, "сеть")
+            outbox.conn.execute("UPDATE jobs SET next_attempt_at = 0")
+            rows = await outbox.unfinished(until_id=await outbox.last_id())
+            self.assertEqual([row[0] for row in rows], [job_id])
+            # Повтор уже поставлен, периодическая проверка его не берет
+            self.assertEqual(await outbox.claim_due(), [])
+        self.run_with_outbox(scenario)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""Проверки разбора запросов (query.py) и их поиска в KeywordMatcher.
+
+Запуск:
+    python -m unittest test_query
+"""
+import random
+import re
+import unittest
+from matcher import KeywordMatcher, normalize_text
+from query import MAX_QUERY_TERMS, QuerySyntaxError, format_query, is_query, parse_query
+
+def term(text, prefix=False):
+    return ('term', text, prefix)
+
+class ParseQueryTest(unittest.TestCase):
+
+    def test_precedence(self):
+        self.assertEqual(
+            parse_query('"a" OR "b" AND "c"'),
+            ('or', (term('a'), ('and', (term('b'), term('c')))))
+        )
+        self.assertEqual(
+            parse_query('("a" OR "b") AND NOT "c"'),
+            ('and', (('or', (term('a'), term('b'))), ('not', term('c'))))
+        )
+
+    def test_juxtaposition_is_or(self):
+        self.assertEqual(parse_query('"a" "b" AND "c"'), parse_query('"a" OR "b" AND "c"'))
+
+    def test_binary_not_is_and_not(self):
+        self.assertEqual(parse_query('"a" NOT "b"'), parse_query('"a" AND NOT "b"'))
+
+    def test_russian_and_lowercase_operators(self):
+        self.assertEqual(parse_query('"a" и не ("b" или "c")'), parse_query('"a" AND NOT ("b" OR "c")'))
+
+    def test_prefix_and_whitespace(self):
+        self.assertEqual(parse_query('"разработ*"'), term('разработ', True))
+        self.assertEqual(parse_query('"  data   analyst "'), term('data analyst'))
+
+    def test_errors(self):
+        for text in (
+            '',
+            '"a" AND',
+            '"a" AND ("b"',
+            '"a")',
+            '"a" AND python',
+            '"a" AND "',
+            '"*"',
+            'NOT',
+        ):
+            with self.subTest(text=text):
+                with self.assertRaises(QuerySyntaxError):
+                    parse_query(text)
+
+    def test_term_limit(self):
+        text = ' OR '.join(f'"w{i}"' for i in range(MAX_QUERY_TERMS))
+        self.assertEqual(parse_query(text)[0], 'or')
+        with self.assertRaises(QuerySyntaxError):
+            parse_query(text + ' OR "extra"')
+
+    def test_is_query(self):
+        self.assertTrue(is_query('"a" AND "b"'))
+        self.assertTrue(is_query('("a")'))
+        self.assertTrue(is_query('"a" не "b"'))
+        self.assertFalse(is_query('"data analyst" "python developer"'))
+        # Операторы внутри кавычек - часть фразы
+        self.assertFalse(is_query('"rock and roll" "(c)"'))
+
+class FormatQueryTest(unittest.TestCase):
+
+    QUERIES = [
+        '"a"',
+        '"a*"',
+        '"a" AND "b" OR "c"',
+        '"a" AND ("b" OR "c")',
+        'NOT ("a" OR "b")',
+        'NOT NOT "a"',
+        '"a" NOT "b" "c"',
+        '("a" OR "b") AND ("c" OR NOT ("d" AND "e*"))',
+        '"питон" и ("сеньор" или "лид") не "стажер"',
+    ]
+
+    def test_canonical_form(self):
+        self.assertEqual(format_query(parse_query('"a" "b" и не "c*"')), '"a" OR "b" AND NOT "c*"')
+        self.assertEqual(format_query(parse_query('("a" OR "b") AND "c"')), '("a" OR "b") AND "c"')
+        self.assertEqual(format_query(parse_query('NOT ("a" AND "b")')), 'NOT ("a" AND "b")')
+
+    def test_round_trip(self):
+        for text in self.QUERIES:
+            with self.subTest(text=text):
+                tree = parse_query(text)
+                canonical = format_query(tree)
+                self.assertEqual(parse_query(canonical), tree)
+                self.assertEqual(format_query(parse_query(canonical)), canonical)
+
+def evaluate(node, text: str) -> bool:
+    """Прямое вычисление запроса по нормализованному тексту"""
+    kind = node[0]
+    if kind == 'term':
+        phrase = re.escape(normalize_text(node[1]))
+        pattern = rf'(?<!\w){phrase}' if node[2] else rf'(?<!\w){phrase}(?!\w)'
+        return re.search(pattern, text) is not None
+    if kind == 'not':
+        return not evaluate(node[1], text)
+    if kind == 'and':
+        return all(evaluate(child, text) for child in node[1])
+    return any(evaluate(child, text) for child in node[1])
+
+class MatcherQueryTest(unittest.TestCase):
+
+    def match(self, keyword: str, text: str) -> bool:
+        return 1 in KeywordMatcher({1: [keyword]}).match(text)
+
+    def test_word_boundaries(self):
+        self.assertTrue(self.match('"python" AND "go"', 'Python, Go!'))
+        self.assertFalse(self.match('"python" AND "go"', 'pythonista and golang'))
+        # Обычное ключевое слово по-прежнему ищется как подстрока
+        self.assertTrue(self.match('python', 'pythonista'))
+
+    def test_prefix(self):
+        self.assertTrue(self.match('"разработ*" OR "x"', 'Ищем разработчика'))
+        self.assertFalse(self.match('"разработ*" OR "x"', 'переразработка'))
+
+    def test_case_and_yo_folding(self):
+        self.assertTrue(self.match('"ёлка" AND "Новый год"', 'ЕЛКА на новый   год'))
+        self.assertTrue(self.match('"елка" OR "x"', 'Ёлка'))
+
+    def test_not_only_query(self):
+        self.assertTrue(self.match('NOT "spam"', 'обычный пост'))
+        self.assertFalse(self.match('NOT "spam"', 'это spam'))
+        # Пост без текста, например фото без подписи, не совпадает ни с чем
+        self.assertFalse(self.match('NOT "spam"', ''))
+        self.assertFalse(self.match('NOT "spam"', '  \n '))
+
+    def test_unparsable_query_is_phrase(self):
+        self.assertTrue(self.match('"a" AND', 'текст "a" and конец'))
+
+    def test_shared_plan(self):
+        matcher = KeywordMatcher({
+            1: ['"python" AND ("senior" OR "lead")'],
+            2: ['("lead" OR "senior") AND "python"'],
+            3: ['"python" AND ("senior" OR "lead") AND NOT "intern"'],
+        })
+        # Общие подвыражения строятся один раз: 4 фразы, OR, NOT и два AND
+        self.assertEqual(matcher.plan_size, 8)
+        self.assertEqual(matcher.match('Senior Python developer'), {1, 2, 3})
+        self.assertEqual(matcher.match('python lead, intern'), {1, 2})
+        self.assertEqual(matcher.match('java lead'), set())
+
+    def test_against_direct_evaluation(self):
+        rng = random.Random(1)
+        words = ['кот', 'котик', 'ёж', 'еж', 'data', 'analyst', 'python', 'go']
+        queries = [
+            '"кот" AND NOT "ёж"',
+            '"кот*" OR ("data analyst" AND "python")',
+            'NOT ("go" OR "python")',
+            '"еж" "кот" NOT "котик"',
+            '("data" AND "go") OR ("analyst" AND NOT "data")',
+        ]
+        matcher = KeywordMatcher({i: [query] for i, query in enumerate(queries)})
+        trees = [parse_query(query) for query in queries]
+        for _ in range(300):
+            text = ' '.join(rng.choice(words) + rng.choice(['', '', ',', 'ы']) for _ in range(rng.randint(1, 6)))
+            expected = {i for i, tree in enumerate(trees) if evaluate(tree, normalize_text(text))}
+            self.assertEqual(matcher.match(text), expected, text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+from typing import Optional, Set
+import logging
+from telethon.tl.functions.channels import JoinChannelRequest, LeaveChannelRequest
+
+logger = logging.getLogger(__name__)
+
+class ChannelWatchSet:
+    """Множество peer ID каналов, которые отслеживает хотя бы один активный пользователь.
+
+    Используется как фильтр событий Telethon: обновления из остальных
+    чатов отбрасываются по chat_id до любых сетевых запросов.
+    """
+
+    def __init__(self, client, storage, join_channels: bool = False, leave_channels: bool = False):
+        self.client = client
+        self.storage = storage
+        self.join_channels = join_channels
+        self.leave_channels = leave_channels
+        self.watched_ids: Set[int] = set()
+        # Каналы, на которые нужно подписаться или из которых выйти
+        self._to_join: Set[int] = set()
+        self._to_leave: Set[int] = set()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        storage.add_channels_listener(self._on_channels_changed)
+
+    def is_watched(self, event) -> bool:
+        """Фильтр событий: синхронная проверка без обращений к сети"""
+        return event.chat_id in self.watched_ids
+
+    def _on_channels_changed(self, added: Set, removed: Set) -> None:
+        # Строки @username еще не переведены в ID и не могут совпасть с chat_id
+        added = {channel for channel in added if isinstance(channel, int)}
+        removed = {channel for channel in removed if isinstance(channel, int)}
+        self.watched_ids |= added
+        self.watched_ids -= removed
+        if self.join_channels:
+            self._to_join = (self._to_join | added) - removed
+        if self.leave_channels:
+            # Покидаем только каналы, которые перестали отслеживаться за время работы
+            self._to_leave = (self._to_leave | removed) - added
+        if self._to_join or self._to_leave:
+            self._changed.set()
+
+    def refresh(self) -> None:
+        """Пересчет множества отслеживаемых каналов по текущим настройкам"""
+        self.watched_ids = {
+            channel for channel in self.storage.get_watched_channels()
+            if isinstance(channel, int)
+        }
+        logger.info(f"Отслеживается каналов: {len(self.watched_ids)}")
+
+    async def _request(self, request, peer_id: int, action: str) -> None:
+        try:
+            entity = await self.client.get_input_entity(peer_id)
+            await self.client(request(entity))
+        except Exception as e:
+            logger.warning(f"Ошибка {action} {peer_id}: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            to_join, self._to_join = self._to_join, set()
+            to_leave, self._to_leave = self._to_leave, set()
+            for peer_id in to_join:
+                await self._request(JoinChannelRequest, peer_id, "подписки на канал")
+            for peer_id in to_leave:
+                await self._request(LeaveChannelRequest, peer_id, "выхода из канала")
+
+    def start(self) -> None:
+        """Первичное заполнение и запуск фоновых подписок и выходов"""
+        self.refresh()
+        if self.join_channels:
+            # Вступление в канал, где аккаунт уже состоит, ничего не меняет
+            self._to_join |= self.watched_ids
+            self._changed.set()
+        if (self.join_channels or self.leave_channels) and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="channel-watch")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import itertools
+import os
+import signal
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+import logging
+from telegram import Bot, InputMediaPhoto
+from telegram.error import BadRequest, Forbidden
+from telegram.request import HTTPXRequest
+from delivery import DeliveryJob, DeliveryScheduler
+from outbox import Outbox
+from media import MediaFanoutCache, photo_file_id
+from metrics import DELIVERIES, STAGE_SECONDS, start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+# Те же переменные окружения, что и у bot.py
+BOT_TOKEN = os.environ.get('BOT_TOKEN')
+MEDIA_CACHE_SIZE = int(os.environ.get('MEDIA_CACHE_SIZE', 1000))
+MEDIA_CACHE_TTL = int(os.environ.get('MEDIA_CACHE_TTL', 3600))
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', 8))
+DELIVERY_QUEUE_SIZE = int(os.environ.get('DELIVERY_QUEUE_SIZE', 1000))
+DELIVERY_GLOBAL_RATE = float(os.environ.get('DELIVERY_GLOBAL_RATE', 30))
+DELIVERY_CHAT_RATE = float(os.environ.get('DELIVERY_CHAT_RATE', 1))
+OUTBOX_FILE = os.environ.get('OUTBOX_FILE', 'outbox.db')
+OUTBOX_RETRY_INTERVAL = float(os.environ.get('OUTBOX_RETRY_INTERVAL', 5))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+# Период проверки новых заданий в журнале (в секундах)
+DELIVERY_POLL_INTERVAL = float(os.environ.get('DELIVERY_POLL_INTERVAL', 0.5))
+# Сколько сообщений держать в памяти между обращениями к журналу
+PAYLOAD_CACHE_SIZE = int(os.environ.get('PAYLOAD_CACHE_SIZE', 1000))
+DELIVERY_LOG_SAMPLE = int(os.environ.get('DELIVERY_LOG_SAMPLE', 0))
+
+class Payload:
+    """Содержимое сообщения канала, записанное процессом приема"""
+
+    def __init__(self, chat_id: int, message_id: int, text: str, media: List[str], file_ids: List[str]):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.media = media
+        self.file_ids = file_ids
+
+    @property
+    def key(self) -> Tuple[int, int]:
+        return (self.chat_id, self.message_id)
+
+class DeliveryWorker:
+    """Процесс доставки одной доли подписчиков: user_id % shards == shard.
+
+    Задания читаются из журнала доставок по возрастанию id, поэтому после
+    перезапуска процесс начинает с незавершенных и продолжает новыми.
+    Отправка и подтверждения устроены так же, как в однопроцессном режиме.
+    """
+
+    def __init__(self, bot: Bot, outbox: Outbox, shard: int, shards: int):
+        self.bot = bot
+        self.outbox = outbox
+        self.shard = (shard, shards)
+        self.media_cache = MediaFanoutCache(max_entries=MEDIA_CACHE_SIZE, ttl=MEDIA_CACHE_TTL)
+        self._payloads: "OrderedDict[Tuple[int, int], Payload]" = OrderedDict()
+        self._delivery_counter = itertools.count(1)
+        # Общий лимит Bot API делится между процессами доставки и процессом
+        # приема, который сам отправляет дайджесты
+        self.scheduler = DeliveryScheduler(
+            send=self.deliver_job,
+            on_done=self.on_delivery_done,
+            on_failed=self.on_delivery_failed,
+            workers=DELIVERY_WORKERS,
+            queue_size=DELIVERY_QUEUE_SIZE,
+            global_rate=DELIVERY_GLOBAL_RATE / (shards + 1),
+            chat_rate=DELIVERY_CHAT_RATE,
+        )
+
+    async def load_payloads(self, keys: List[Tuple[int, int]]) -> Dict[Tuple[int, int], Payload]:
+        """Содержимое сообщений из кэша или журнала"""
+        payloads = {key: self._payloads[key] for key in keys if key in self._payloads}
+        missing = [key for key in keys if key not in payloads]
+        if missing:
+            for key, (text, media, file_ids) in (await self.outbox.get_payloads(missing)).items():
+                payloads[key] = self._payloads[key] = Payload(*key, text, media, file_ids)
+        for key in payloads:
+            self._payloads.move_to_end(key)
+        while len(self._payloads) > PAYLOAD_CACHE_SIZE:
+            self._payloads.popitem(last=False)
+        return payloads
+
+    async def submit_rows(self, rows: List[tuple]) -> None:
+        """Постановка заданий журнала в очередь доставки"""
+        payloads = await self.load_payloads(list({(row[1], row[2]) for row in rows}))
+        for job_id, chat_id, message_id, grouped_id, user_id in rows:
+            payload = payloads.get((chat_id, message_id))
+            if payload is None:
+                await self.outbox.fail(job_id, "Нет содержимого сообщения", permanent=True)
+                continue
+            await self.scheduler.submit(DeliveryJob(user_id, payload, outbox_id=job_id))
+
+    async def send_media(self, chat_id: int, payload: Payload) -> None:
+        """Отправка фото по file_id или загрузка файлов при первой доставке"""
+        file_ids = self.media_cache.get(payload.key) or payload.file_ids
+        if not file_ids:
+            # Блокировка только на загрузку, параллельные доставки того же
+            # сообщения дождутся file_id
+            async with self.media_cache.lock(payload.key):
+                file_ids = self.media_cache.get(payload.key) or payload.file_ids
+                if not file_ids:
+                    await self.upload_media(chat_id, payload)
+                    return
+        # Копии по file_id отправляются без блокировки, параллельно
+        if len(file_ids) == 1:
+            await self.bot.send_photo(chat_id=chat_id, photo=file_ids[0], caption=payload.text)
+        else:
+            await self.bot.send_media_group(
+                chat_id=chat_id,
+                media=[
+                    InputMediaPhoto(file_id, caption=payload.text if i == 0 else None)
+                    for i, file_id in enumerate(file_ids)
+                ]
+            )
+
+    async def upload_media(self, chat_id: int, payload: Payload) -> None:
+        """Первая отправка файлов с сохранением file_id в кэш и журнал"""
+        paths = [path for path in payload.media if os.path.exists(path)]
+        if not paths:
+            # Файлы уже удалены, отправляем только текст
+            await self.bot.send_message(chat_id=chat_id, text=payload.text, disable_web_page_preview=True)
+            return
+        files = [open(path, 'rb') for path in paths]
+        try:
+            if len(files) == 1:
+                sent = await self.bot.send_photo(chat_id=chat_id, photo=files[0], caption=payload.text)
+                file_ids = [photo_file_id(sent)]
+            else:
+                sent_messages = await self.bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[
+                        InputMediaPhoto(file, caption=payload.text if i == 0 else None)
+                        for i, file in enumerate(files)
+                    ]
+                )
+                file_ids = [photo_file_id(sent) for sent in sent_messages]
+        finally:
+            for file in files:
+                file.close()
+        if all(file_ids):
+            self.media_cache.put(payload.key, file_ids)
+            payload.file_ids = file_ids
+            # Другие процессы доставки возьмут file_id из журнала
+            try:
+                await self.outbox.set_file_ids(payload.chat_id, payload.message_id, file_ids)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения file_id сообщения {payload.message_id}: {e}")
+
+    async def deliver_job(self, job: DeliveryJob) -> None:
+        if job.attempts == 1:
+            STAGE_SECONDS.observe(time.monotonic() - job.enqueued_at, 'queue_wait')
+        payload = job.message
+        with STAGE_SECONDS.time('send'):
+            if payload.media:
+                await self.send_media(job.user_id, payload)
+            else:
+                await self.bot.send_message(chat_id=job.user_id, text=payload.text, disable_web_page_preview=True)
+        if not DELIVERY_LOG_SAMPLE:
+            logger.info(f"Сообщение успешно отправлено пользователю {job.user_id}")
+            return
+        # Как в bot.py: строка лога только для каждой N-й доставки при уровне DEBUG
+        number = next(self._delivery_counter)
+        if number % DELIVERY_LOG_SAMPLE == 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Сообщение успешно отправлено пользователю {job.user_id} (доставка {number})")
+
+    async def on_delivery_done(self, job: DeliveryJob) -> None:
+        DELIVERIES.inc('done')
+        self.outbox.ack(job.outbox_id)
+
+    async def on_delivery_failed(self, job: DeliveryJob, error: Exception) -> None:
+        DELIVERIES.inc('failed')
+        permanent = isinstance(error, (BadRequest, Forbidden))
+        await self.outbox.fail(job.outbox_id, str(error), permanent=permanent)
+
+    async def run(self, stop_event: asyncio.Event) -> None:
+        """Чтение новых заданий своей доли и повторов до сигнала остановки"""
+        after_id = 0
+        last_claim = time.monotonic()
+        total = 0
+        while not stop_event.is_set():
+            try:
+                rows = await self.outbox.unfinished(after_id=after_id, shard=self.shard)
+                if rows:
+                    after_id = rows[-1][0]
+                    total += len(rows)
+                    await self.submit_rows(rows)
+                    continue
+                if total:
+                    logger.info(f"Поставлено доставок из журнала: {total}")
+                    total = 0
+                # Повторы проверяются, когда все задания до конца журнала уже поставлены
+                if time.monotonic() - last_claim >= OUTBOX_RETRY_INTERVAL:
+                    last_claim = time.monotonic()
+                    due = await self.outbox.claim_due(shard=self.shard)
+                    if due:
+                        await self.submit_rows(due)
+            except Exception as e:
+                logger.error(f"Ошибка чтения журнала доставок: {e}")
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=DELIVERY_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+async def main(shard: int, shards: int):
+    # У Bot по умолчанию одно соединение: параллельные отправки ждали бы его
+    # и падали с TimedOut, поэтому соединений столько же, сколько отправителей
+    bot = Bot(BOT_TOKEN, request=HTTPXRequest(connection_pool_size=DELIVERY_WORKERS))
+    await bot.initialize()
+    outbox = Outbox(OUTBOX_FILE)
+    worker = DeliveryWorker(bot, outbox, shard, shards)
+    worker.scheduler.start()
+    outbox.start()
+
+    metrics_server = None
+    if METRICS_PORT:
+        # Каждый процесс доставки отдает метрики на своем порту после порта приема
+        try:
+            metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT + 1 + shard)
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик: {e}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    logger.info(f"Процесс доставки {shard} из {shards} запущен")
+    try:
+        await worker.run(stop_event)
+    finally:
+        logger.info(f"Останавливаем процесс доставки {shard}")
+        if metrics_server is not None:
+            metrics_server.close()
+        # Недоставленное останется в журнале и будет поставлено при следующем запуске
+        await worker.scheduler.stop(drain=False)
+        await outbox.close()
+        await bot.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Процесс доставки для части подписчиков")
+    parser.add_argument('--shard', type=int, default=0, help="номер доли подписчиков, с нуля")
+    parser.add_argument('--shards', type=int, default=1, help="всего процессов доставки")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=f'%(asctime)s - worker {args.shard} - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    if not 0 <= args.shard < args.shards:
+        parser.error("--shard должен быть от 0 до --shards - 1")
+    asyncio.run(main(args.shard, args.shards))